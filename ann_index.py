@@ -0,0 +1,219 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+# Defaults for the index built by save_model; n_probes can be changed per worker without a rebuild
+n_tables = int(os.environ.get('blf_ann_tables', 16))
+n_bits = int(os.environ['blf_ann_bits']) if os.environ.get('blf_ann_bits') else None
+n_probes = int(os.environ.get('blf_ann_probes', 2))
+
+# Target number of users per bucket when n_bits is chosen from the number of users
+bucket_size = 256
+
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+def _signs(cols, n_planes, seed):
+    ''' Random +1/-1 hyperplane coefficients for the given feature columns (or the blf_book_ids of the columns),
+        generated from a hash of (seed, column, plane) so the projection matrix never has to be stored.
+        Returns: float32 array (len(cols) x n_planes)
+    '''
+    with np.errstate(over='ignore'):
+        x = (cols.astype(np.uint64)[:, None] * np.uint64(n_planes) + np.arange(n_planes, dtype=np.uint64)[None, :]
+             + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15))
+        x = (x ^ (x >> np.uint64(30))) * _MIX1
+        x = (x ^ (x >> np.uint64(27))) * _MIX2
+        x = x ^ (x >> np.uint64(31))
+    return np.where(x & np.uint64(1), 1.0, -1.0).astype(np.float32)
+
+def normalize_rows(X):
+    '''L2 normalize the rows of a sparse matrix (cosine similarity becomes a dot product).'''
+    X = sparse.csr_matrix(X, dtype=np.float32)
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(X).tocsr().astype(np.float32)
+
+class LSHNearestNeighbors:
+    ''' Approximate cosine nearest neighbors with random hyperplane LSH over normalized sparse vectors.
+        Same kneighbors interface as sklearn's NearestNeighbors, so get_recs_by_user can use either.
+        n_tables/n_bits are fixed when the index is built (n_bits=None picks it from the number of users
+        so buckets hold around bucket_size users), n_probes (extra buckets searched per table,
+        flipping the least certain bits) trades latency for recall at query time.
+        When fitted with the blf_book_id of each column the hyperplanes are keyed on the book ids, so the codes
+        of unchanged users stay valid when update inserts new books (and moves the columns after them).
+        The index searches the matrix it was fitted on without copying it, and is pickled without it:
+        attach the same matrix after loading (model_registry.load attaches the model's features).
+    '''
+    def __init__(self, n_neighbors=20, n_tables=n_tables, n_bits=n_bits, n_probes=n_probes,
+                 max_candidates=20000, chunk_size=20000, seed=0):
+        self.n_neighbors = n_neighbors
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.max_candidates = max_candidates
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+    def _project_chunk(self, chunk):
+        # chunk is CSR, returns its dense projections (rows x tables*bits). Row norms do not change the signs,
+        # so rows are hashed without normalizing them
+        n_planes = self.n_tables * self.n_bits
+        cols = np.unique(chunk.indices)
+        if not len(cols):
+            return np.zeros((chunk.shape[0], n_planes), dtype=np.float32)
+        book_ids = getattr(self, 'book_ids', None)
+        keys = book_ids[cols] if book_ids is not None else cols
+        return chunk[:, cols].dot(_signs(keys, n_planes, self.seed))
+
+    def _project(self, X):
+        # Dense projections of all the rows of X, only used for the (few) query rows
+        return np.vstack([self._project_chunk(X[start:start + self.chunk_size])
+                          for start in range(0, max(X.shape[0], 1), self.chunk_size)])
+
+    def _codes(self, proj):
+        bits = (proj > 0).reshape(proj.shape[0], self.n_tables, self.n_bits)
+        return bits.astype(np.int32).dot(1 << np.arange(self.n_bits, dtype=np.int32))
+
+    def _hash(self, X):
+        # Bucket codes (rows x tables) computed a chunk at a time, so only the int32 codes of all the rows are kept
+        codes = np.empty((X.shape[0], self.n_tables), dtype=np.int32)
+        for start in range(0, X.shape[0], self.chunk_size):
+            codes[start:start + self.chunk_size] = self._codes(self._project_chunk(X[start:start + self.chunk_size]))
+        return codes
+
+    def attach(self, X):
+        ''' Search X, the users x books matrix the index was fitted on (or last updated with). Only its row norms
+            are computed, X itself is kept as it is.'''
+        self._fit_X = sparse.csr_matrix(X, dtype=np.float32)
+        norms = np.sqrt(np.asarray(self._fit_X.multiply(self._fit_X).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self._norms = norms.astype(np.float32)
+        return self
+
+    def __getstate__(self):
+        # The matrix is saved once, as the model's features
+        return {name: value for name, value in self.__dict__.items() if name not in ('_fit_X', '_norms')}
+
+    def fit(self, X, book_ids=None):
+        ''' Args: X (users x books sparse matrix), book_ids (blf_book_id of each column, optional) '''
+        self.book_ids = None if book_ids is None else np.asarray(book_ids, dtype=np.int64)
+        self.attach(X)
+        if self.n_bits is None:
+            self.n_bits = int(np.clip(round(np.log2(max(X.shape[0], 1) / bucket_size)), 4, 30))
+        self._index(self._hash(self._fit_X))
+        return self
+
+    def _index(self, codes):
+        # One sorted code array per table; a bucket is the slice of rows sharing a code
+        self._order = np.argsort(codes, axis=0, kind='stable').astype(np.int32).T.copy()
+        self._sorted_codes = np.take_along_axis(codes, self._order.T, axis=0).T.copy()
+
+    def update(self, X, row_map, changed_rows, book_ids=None):
+        ''' Refresh the index after rows were added or changed, hashing only those rows again
+            (n_bits and the hyperplanes stay the same). An index fitted without book_ids hashes every row
+            again, since new books shift the columns its hyperplanes are keyed on.
+            Args: X (updated matrix), row_map (row of X of each row the index was fitted on),
+                  changed_rows (rows of X that are new or have changed), book_ids (blf_book_id of each column of X)
+        '''
+        self.attach(X)
+        if getattr(self, 'book_ids', None) is None or book_ids is None:
+            self.book_ids = None if book_ids is None else np.asarray(book_ids, dtype=np.int64)
+            self._index(self._hash(self._fit_X))
+            return self
+
+        old_codes = np.empty((len(row_map), self.n_tables), dtype=np.int32)
+        for t in range(self.n_tables):
+            old_codes[self._order[t], t] = self._sorted_codes[t]
+        codes = np.zeros((X.shape[0], self.n_tables), dtype=np.int32)
+        codes[row_map] = old_codes
+
+        self.book_ids = np.asarray(book_ids, dtype=np.int64)
+        codes[changed_rows] = self._hash(self._fit_X[changed_rows])
+        self._index(codes)
+        return self
+
+    def _candidates(self, proj_row, n_probes):
+        proj_row = proj_row.reshape(self.n_tables, self.n_bits)
+        codes = (proj_row > 0).astype(np.int32).dot(1 << np.arange(self.n_bits, dtype=np.int32))
+        found = []
+        total = 0
+        for t in range(self.n_tables):
+            # Probe the exact bucket first, then buckets one bit flip away (least confident bits first)
+            probes = [codes[t]] + [codes[t] ^ (1 << int(b)) for b in np.argsort(np.abs(proj_row[t]))[:n_probes]]
+            for code in probes:
+                lo, hi = np.searchsorted(self._sorted_codes[t], [code, code + 1])
+                if hi > lo:
+                    rows = self._order[t, lo:min(hi, lo + self.max_candidates - total)]
+                    found.append(rows)
+                    total += len(rows)
+                if total >= self.max_candidates:
+                    return np.unique(np.concatenate(found))
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int32)
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True, n_probes=None):
+        ''' Args: X (sparse or dense query rows), n_neighbors (defaults to the value given at build time),
+                  n_probes (defaults to the value given at build time)
+            Returns: distances (1 - cosine similarity), indices -- both (queries x n_neighbors)
+        '''
+        if getattr(self, '_fit_X', None) is None:
+            raise ValueError('no matrix to search, attach the matrix the index was fitted on')
+        k = n_neighbors or self.n_neighbors
+        n_probes = self.n_probes if n_probes is None else n_probes
+        Q = normalize_rows(X)
+        proj = self._project(Q)
+
+        dists = np.ones((Q.shape[0], k), dtype=np.float32)
+        indices = np.zeros((Q.shape[0], k), dtype=np.int64)
+        for i in range(Q.shape[0]):
+            cand = self._candidates(proj[i], n_probes)
+            if len(cand) < k:
+                # Not enough candidates in the buckets, fall back to an exact search
+                cand = np.arange(self._fit_X.shape[0])
+            sims = self._fit_X[cand].dot(Q[i].T).toarray().ravel() / self._norms[cand]
+            top = np.argpartition(-sims, k - 1)[:k] if len(sims) > k else np.arange(len(sims))
+            top = top[np.argsort(-sims[top], kind='stable')]
+            dists[i, :len(top)] = 1 - sims[top]
+            indices[i, :len(top)] = cand[top]
+        if return_distance:
+            return dists, indices
+        return indices
+
+def compare(ann, nn, X, n_neighbors=None, probes=(0, 1, 2, 4, 8)):
+    ''' Compare the approximate index with exact brute force (sklearn NearestNeighbors) on the query rows X.
+        Returns: list of dictionaries with n_probes, recall and milliseconds per query
+    '''
+    k = n_neighbors or ann.n_neighbors
+    time1 = time.perf_counter()
+    exact_dists, _ = nn.kneighbors(X, n_neighbors=k)
+    brute_ms = (time.perf_counter() - time1) * 1000 / X.shape[0]
+    results = [{'n_probes': 'brute', 'recall': 1.0, 'ms_per_query': brute_ms}]
+
+    for p in probes:
+        time1 = time.perf_counter()
+        approx_dists, _ = ann.kneighbors(X, n_neighbors=k, n_probes=p)
+        ms = (time.perf_counter() - time1) * 1000 / X.shape[0]
+        # Neighbors count as found if they are at least as close as the k-th exact neighbor (users tie a lot)
+        recall = float(np.mean(approx_dists <= exact_dists[:, -1:] + 1e-6))
+        results.append({'n_probes': p, 'recall': recall, 'ms_per_query': ms})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_dir', type=str, default='.')
+    parser.add_argument('--sample', type=int, default=200, help='number of users to query')
+    parser.add_argument('--probes', type=int, nargs='+', default=[0, 1, 2, 4, 8])
+    args = parser.parse_args()
+
+    import model_registry
+    model = model_registry.load(args.model_dir)
+    features = model['features']
+    rows = np.random.default_rng(0).choice(features.shape[0], min(args.sample, features.shape[0]), replace=False)
+
+    for result in compare(model['ann'], model['nn'], features[rows], probes=args.probes):
+        print(result)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,54 @@
+import db
 import form_info
 import book_recs_pred
+import model_registry
+import os
 
-from flask import Flask, render_template,request
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Flask, abort, jsonify, render_template,request
 
 
 
 app = Flask(__name__)
 
+# Load the model when the worker starts instead of on the first request
+if os.environ.get('blf_model_preload') == 'Yes':
+    model_registry.get_model()
+
+# Location and book recommendations run in parallel threads (set blf_concurrent_recs=No to run them in turn).
+# Past request_deadline seconds the page is rendered with whatever finished.
+concurrent_recs = os.environ.get('blf_concurrent_recs', 'Yes') == 'Yes'
+request_deadline = float(os.environ.get('blf_request_deadline', 10))
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('blf_request_threads', 8)))
+
+def loc_books(location):
+    # Based on location, get similar users and then recommendations based on similar users
+    return book_recs_pred.get_books(book_recs_pred.get_recs_by_loc(location))
+
+def user_books(id, book):
+    # Based on book, get similar users and then recommendations based on similar users
+    book_rec_book_id = book_recs_pred.get_recs_by_user(id,book)
+    print(book_rec_book_id)
+    return book_recs_pred.get_books(book_rec_book_id)
+
+def run_all(*calls):
+    ''' Run the calls (function, args...) concurrently and wait until they finish or request_deadline passes.
+        Returns: list of the results, an empty list for the calls that did not finish in time
+    '''
+    if not concurrent_recs:
+        return [func(*args) for func, *args in calls]
+    futures = [executor.submit(func, *args) for func, *args in calls]
+    wait(futures, timeout=request_deadline)
+    results = []
+    for future in futures:
+        if not future.done():
+            print('recommendations timed out')
+            future.cancel()
+            results.append([])
+        else:
+            results.append(future.result())
+    return results
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -20,6 +61,25 @@ def form():
 def about():
     return render_template('about.html')
 
+@app.route('/health')
+def health():
+    # Database health, connection pool stats, loaded model version and cache counters for this worker
+    healthy = db.health_check()
+    return jsonify(healthy=healthy, pool=db.pool_stats(), model_version=model_registry.registry.version,
+                   cache=book_recs_pred.cache_stats()), 200 if healthy else 503
+
+@app.route('/api/titles')
+def api_titles():
+    # Autocomplete for the title field: most rated titles starting with the prefix typed so far
+    prefix = request.args.get('prefix', '')
+    k = max(1, min(request.args.get('k', 10, type=int), 50))
+    title_index = model_registry.get_model().get('title_index')
+    matches = title_index.complete(prefix, k) if title_index is not None else []
+    response = jsonify(matches)
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    return response
+
 @app.route('/data/', methods = ['POST','GET'])
 def data():
     if request.method == 'GET':
@@ -31,29 +91,24 @@ def data():
         book = form_data['title']
         id = form_info.get_blf_book_id(book)
 
-        # Based on location, get similar users and then recommendations based on similar users
-        book_rec_loc_id = book_recs_pred.get_recs_by_loc(location)
-
-        # Based on book, get similar users and then recommendations based on similar users
-        book_rec_book_id = book_recs_pred.get_recs_by_user(id,book)
-        print(book_rec_book_id)
-
-        # Get books from database with IDs in the book_rec_book_id
-        new_df_bx_books_book = book_recs_pred.get_books(book_rec_book_id)
-        book_rec_loc_books = book_recs_pred.get_books(book_rec_loc_id)
-
-        # Translate dataframe to table format in HTML (render_links = True, escape = False to make covers display)
-        book_list_loc_html=book_rec_loc_books[['cover','title','authors']].to_html(index=False,render_links=True,escape=False)
-        book_list_loc = book_list_loc_html.replace('table border="1"','table border="0"').replace('<tr style="text-align: right;">', '<tr style="text-align: left;">').replace('<th>', '<th align="left">')
+        # Book not found (or never rated 5 stars): suggest the closest titles instead
+        if id is None:
+            book_rec_loc_books, candidates = run_all((loc_books, location),
+                                                     (form_info.get_title_candidates, book))
+            return render_template('data.html',books_loc = book_rec_loc_books, books_book = [], book=book,
+                                   location=location, candidates=candidates)
 
-        # Translate dataframe to table format in HTML (render_links = True, escape = False to make covers display)
-        book_list_book_html=new_df_bx_books_book[['cover','title','authors']].to_html(index=False,render_links=True,escape=False)
-        book_list_book = book_list_book_html.replace('table border="1"','table border="0"').replace('<tr style="text-align: right;">', '<tr style="text-align: left;">').replace('<th>', '<th align="left">')
+        # The location and book pipelines are independent, so the page waits for the slower one only
+        book_rec_loc_books, book_rec_book_books = run_all((loc_books, location), (user_books, id, book))
 
-        return render_template('data.html',book_list_loc = book_list_loc, book_list_book = book_list_book, book=book, location=location)
+        # Tables are rendered from the records by the book_table macro (templates/macros.html)
+        return render_template('data.html',books_loc = book_rec_loc_books, books_book = book_rec_book_books, book=book, location=location)
 
 @app.route('/book/<blf_book_id>')
 def bookdetails(blf_book_id):
-    book = book_recs_pred.get_books([blf_book_id]).to_dict(orient='records')[0]
+    books = book_recs_pred.get_books([blf_book_id]) if blf_book_id.isdigit() else []
+    if not books:
+        abort(404)
+    book = books[0]
     print(book)
     return render_template('book_details_new.html', book = book)
\ No newline at end of file
@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import book_recs_pred
+import book_recs_save
+import columnar_store
+import db
+import form_info
+import locations
+import model_registry
+import synthetic_data
+import titles
+import training
+
+# Times the model build and the website's request path on synthetic_data datasets of several sizes, with the
+# columnar store as the database, and writes the results as JSON so runs on different commits can be compared
+# (--compare). Query stages call the uncached functions, except data_request_cached.
+
+def summary(ms):
+    '''Timings in milliseconds summarized as n, mean, median, 95th percentile and max.'''
+    ms = np.asarray(ms)
+    return {'n': len(ms), 'mean_ms': round(float(ms.mean()), 3), 'p50_ms': round(float(np.percentile(ms, 50)), 3),
+            'p95_ms': round(float(np.percentile(ms, 95)), 3), 'max_ms': round(float(ms.max()), 3)}
+
+def time_calls(func, calls):
+    ''' Time func on every argument tuple in calls, with the request path's prints silenced.
+        Returns: summary of the timings
+    '''
+    ms = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for args in calls:
+            time1 = time.perf_counter()
+            func(*args)
+            ms.append((time.perf_counter() - time1) * 1000)
+    return summary(ms)
+
+@contextlib.contextmanager
+def settings(module, **values):
+    '''Temporarily set module level settings (e.g. book_recs_pred.knn_backend).'''
+    old = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            setattr(module, name, value)
+
+def build(books, users, ratings, directory):
+    ''' Build and publish every model artifact the website uses into directory, as merge_data does.
+        Returns: dictionary of stage: seconds
+    '''
+    model_registry.model_dir = directory
+    model_registry.registry.directory = directory
+    seconds = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        time1 = time.perf_counter()
+        book_recs_save.save_model(ratings)
+        seconds['model'] = time.perf_counter() - time1
+
+        time1 = time.perf_counter()
+        rankings, stats = locations.build_rankings(ratings, users)
+        model_registry.publish({'location_rankings': rankings, 'location_stats': stats,
+                                'location_index': locations.LocationIndex.build(users)})
+        seconds['location_rankings'] = time.perf_counter() - time1
+
+        time1 = time.perf_counter()
+        model_registry.publish({'title_index': titles.TitleIndex.build(books, ratings)})
+        seconds['title_index'] = time.perf_counter() - time1
+
+        time1 = time.perf_counter()
+        columnar_store.publish(ratings, users, books, os.path.join(directory, 'store'))
+        seconds['columnar_store'] = time.perf_counter() - time1
+
+        time1 = time.perf_counter()
+        model_registry.registry.reload()
+        seconds['model_load'] = time.perf_counter() - time1
+    return {stage: round(s, 3) for stage, s in seconds.items()}
+
+def query_samples(books, users, ratings, n, seed):
+    ''' What users type in the form: titles of 5 star rated books picked by popularity (with a typo and as a
+        prefix), and locations of BX users (full, city and country).
+        Returns: dictionary of sample lists
+    '''
+    rng = np.random.default_rng(seed)
+    five_star = ratings.loc[ratings['book_rating'] == 5.0, 'blf_book_id'].value_counts()
+    picked = rng.choice(five_star.index.to_numpy(), n, p=(five_star / five_star.sum()).to_numpy())
+    title = books.set_index('blf_book_id')['title']
+    picked_titles = [title[book_id] for book_id in picked]
+    typos = [t[:i] + t[i + 1:] for t, i in zip(picked_titles, rng.integers(0, 4, n))]
+    user_locations = users['location'].dropna().sample(n, replace=True, random_state=seed).to_list()
+    parts = [location.split(', ') for location in user_locations]
+    location_queries = [[location, p[0], p[-1]][i % 3] for i, (location, p) in enumerate(zip(user_locations, parts))]
+    return {'books': [(int(book_id), t) for book_id, t in zip(picked, picked_titles)], 'typos': typos,
+            'prefixes': [t[:rng.integers(1, 6)] for t in picked_titles], 'locations': location_queries}
+
+def run_queries(samples):
+    '''Time the request path stages on the samples. Returns: dictionary of stage: summary'''
+    import app
+    results = {}
+    by_user = book_recs_pred.get_recs_by_user.__wrapped__
+    by_loc = book_recs_pred.get_recs_by_loc.__wrapped__
+    model = model_registry.get_model()
+
+    with settings(book_recs_pred, book_recs_source='knn', knn_backend='brute'):
+        results['knn_brute'] = time_calls(by_user, samples['books'])
+    with settings(book_recs_pred, book_recs_source='knn', knn_backend='ann'):
+        results['knn_ann'] = time_calls(by_user, samples['books'])
+    with settings(book_recs_pred, book_recs_source='item'):
+        results['item_similarity'] = time_calls(by_user, samples['books'])
+    with settings(book_recs_pred, loc_recs_source='precomputed'):
+        results['location_precomputed'] = time_calls(by_loc, [(l,) for l in samples['locations']])
+    with settings(book_recs_pred, loc_recs_source='live'):
+        results['location_live'] = time_calls(by_loc, [(l,) for l in samples['locations']])
+    results['get_books'] = time_calls(book_recs_pred.get_books, [([book_id for book_id, t in samples['books'][:5]],)])
+
+    results['title_exact'] = time_calls(form_info.get_blf_book_id, [(t,) for book_id, t in samples['books']])
+    results['title_fuzzy'] = time_calls(form_info.get_title_candidates, [(t,) for t in samples['typos']])
+    results['title_complete'] = time_calls(model['title_index'].complete, [(p,) for p in samples['prefixes']])
+
+    # Full /data/ requests through Flask: location and book recommendations, records and the template
+    client = app.app.test_client()
+    forms = [{'location': location, 'title': t} for location, (book_id, t) in zip(samples['locations'], samples['books'])]
+
+    def post(form, clear):
+        if clear:
+            book_recs_pred.clear_caches()
+        assert client.post('/data/', data=form).status_code == 200
+
+    results['data_request'] = time_calls(post, [(form, True) for form in forms])
+    # Untimed pass so every form's results are cached, then the same forms again: all cache hits
+    book_recs_pred.clear_caches()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for form in forms:
+            post(form, False)
+    misses = book_recs_pred.loc_cache.misses + book_recs_pred.book_cache.misses
+    results['data_request_cached'] = time_calls(post, [(form, False) for form in forms])
+    results['data_request_cached']['cache_misses'] = book_recs_pred.loc_cache.misses + book_recs_pred.book_cache.misses - misses
+    return results
+
+def run(scales, n_queries, seed):
+    ''' Generate, build and query each scale.
+        Returns: dictionary of scale: {'rows', 'build' (seconds), 'queries' (summaries), 'peak_rss_mb'}
+    '''
+    results = {}
+    with settings(db, backend='columnar'), settings(model_registry, model_dir=model_registry.model_dir):
+        for scale in scales:
+            time1 = time.perf_counter()
+            books, users, ratings = synthetic_data.generate(scale, seed)
+            generate_seconds = time.perf_counter() - time1
+            with tempfile.TemporaryDirectory() as directory:
+                build_seconds = build(books, users, ratings, directory)
+                build_seconds['generate'] = round(generate_seconds, 3)
+                queries = run_queries(query_samples(books, users, ratings, n_queries, seed))
+            results[str(scale)] = {'rows': {'books': len(books), 'users': len(users), 'ratings': len(ratings)},
+                                   'build': build_seconds, 'queries': queries,
+                                   'peak_rss_mb': round(training.peak_rss_mb(), 1)}
+            print(f'scale {scale}: {len(ratings)} ratings, model built in {build_seconds["model"]:.1f} s, /data/ p50 '
+                  f'{queries["data_request"]["p50_ms"]:.1f} ms')
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    ''' Compare the build seconds and query medians with a baseline run of the same scales.
+        Returns: list of the regressions (stage slower than tolerance x baseline)
+    '''
+    regressions = []
+    for scale, result in results['scales'].items():
+        old = baseline['scales'].get(scale)
+        if old is None:
+            continue
+        pairs = [(f'build {stage}', seconds, old['build'].get(stage)) for stage, seconds in result['build'].items()]
+        pairs += [(stage, timing['p50_ms'], old['queries'].get(stage, {}).get('p50_ms'))
+                  for stage, timing in result['queries'].items()]
+        for stage, new_value, old_value in pairs:
+            if not old_value:
+                continue
+            ratio = new_value / old_value
+            flag = ' REGRESSION' if ratio > tolerance else ''
+            print(f'scale {scale} {stage}: {old_value} -> {new_value} ({ratio:.2f}x){flag}')
+            if flag:
+                regressions.append((scale, stage, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.1, 0.3, 1.0], help='synthetic_data scales')
+    parser.add_argument('--queries', type=int, default=50, help='requests timed per stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, help='results JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown ratio counted as a regression')
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(), 'created': str(datetime.now()), 'python': platform.python_version(),
+               'numpy': np.__version__, 'machine': platform.machine(), 'cpu_count': os.cpu_count(),
+               'seed': args.seed, 'queries': args.queries,
+               'scales': run(args.scales, args.queries, args.seed)}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to', args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 import pandas as pd
+import scoring
 from sklearn import base
 from sklearn.feature_extraction import DictVectorizer
 from sklearn.pipeline import Pipeline, FeatureUnion
@@ -20,18 +21,10 @@ from sklearn.decomposition import TruncatedSVD
 #                 return {}
 #         return X[self.col].apply(to_dict)
 
-def bayes_sum(N, mu):
-    return lambda x: (x.sum() + mu*N) / (x.count() + N)
-
 def thumbnails(df):
-    thumbnails = []
-    for index,row in df.iterrows():
-        image_link = row['Image-URL-S']
-        book_title = row['Book-Title']
-        isbn = row['ISBN']
-        thumbnail_url = f'<a href="/book/{isbn}"><img src={image_link} alt={book_title}>'
-        thumbnails.append(thumbnail_url)
-    return thumbnails
+    thumbnails = ('<a href="/book/' + df['ISBN'].map(str) + '"><img src=' + df['Image-URL-S'].map(str)
+                  + ' alt=' + df['Book-Title'].map(str) + '>')
+    return thumbnails.tolist()
 
 def get_similar_users(df_users, location):
     '''Find all users with a location containing the string entered in the form field -- future plan 
@@ -48,10 +41,9 @@ def get_recs_by_loc(df_users,df_ratings,location):
 
     # Filter df_ratings by only the "closest" users
     sim_user_ratings = df_ratings[df_ratings['User-ID'].isin(df_sim_users.index)]
-    ratings_grp_mult = sim_user_ratings.groupby('ISBN')['Book-Rating']
 
     # Calculate Bayes sum for user ratings and return top 5 books based on Bayes sum
-    return ratings_grp_mult.aggregate(bayes_sum(5,3)).sort_values(ascending = False).head().index.tolist()
+    return scoring.bayes_top(sim_user_ratings['ISBN'].to_numpy(), sim_user_ratings['Book-Rating'].to_numpy(), 5, 5, 3)
 
 def get_recs_by_user(df_users, df_ratings, userid, isbn):
     ''' Uses K-Nearest Neighbors to get the top 5 books based on other users who have highly rated the same book.
@@ -77,7 +69,7 @@ def get_recs_by_user(df_users, df_ratings, userid, isbn):
     nn = NearestNeighbors(n_neighbors=20, metric='cosine', algorithm='brute').fit(features)
     dists, indices = nn.kneighbors(features[by_user_ratings.index.get_loc(uid_max), :])
     neighbors = [by_user_ratings.index[i] for i in indices[0]][1:]
-    ratings_grp = df_ratings[df_ratings['User-ID'].isin(neighbors)].groupby('ISBN')['Book-Rating']
+    neighbor_ratings = df_ratings[df_ratings['User-ID'].isin(neighbors)]
 
     # Calculate bayes sum aggregation on ratings
-    return ratings_grp.aggregate(bayes_sum(5,3)).sort_values(ascending = False).head().index.tolist()
\ No newline at end of file
+    return scoring.bayes_top(neighbor_ratings['ISBN'].to_numpy(), neighbor_ratings['Book-Rating'].to_numpy(), 5, 5, 3)
\ No newline at end of file
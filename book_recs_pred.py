@@ -1,194 +1,214 @@
 # from data_prep import config
-import joblib
 import numpy as np
 import os
-import pandas as pd
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.neighbors import NearestNeighbors
+from scipy import sparse
 
-sql_url = os.environ.get('blf_sql')
+from ann_index import normalize_rows
+import db
+import model_registry
+import result_cache
+import scoring
 
-def bayes_sum(N, mu):
-    return lambda x: (x.sum() + mu*N) / (x.count() + N)
+# 'brute' (exact NearestNeighbors) or 'ann' (ann_index.LSHNearestNeighbors)
+knn_backend = os.environ.get('blf_knn_backend', 'brute')
+
+# 'precomputed' (locations.LocationRankings built by merge_data, falling back to the database
+# for unknown locations) or 'live' (always rank from the database)
+loc_recs_source = os.environ.get('blf_loc_recs', 'precomputed')
+
+# 'knn' (neighbors of the users who rated the book a 5) or 'item' (item_similarity table built by save_model)
+book_recs_source = os.environ.get('blf_book_recs', 'knn')
+
+# How the users who rated the book a 5 are turned into kNN queries, see query_neighbors
+knn_query_mode = os.environ.get('blf_knn_query', 'centroid')
+max_query_users = int(os.environ.get('blf_knn_max_users', 500))
+query_chunk_size = 100
+
+# Where the Bayes sum of the candidate users' ratings is computed: 'app' (ratings are fetched and ranked with
+# scoring.py) or 'sql' (GROUP BY in PostgreSQL, only the top books are returned)
+aggregation = os.environ.get('blf_aggregation', 'app')
+
+# Recommendation caches for the location and the book halves of /data/, emptied when a new model version
+# or data load is published. Keys are the model version and the arguments as typed: the database fallbacks
+# match the raw strings, and a result computed while a new version is swapped in is never served under it
+cache_ttl = float(os.environ.get('blf_cache_ttl', 3600))
+loc_cache = result_cache.TTLCache(int(os.environ.get('blf_cache_loc_size', 1024)), cache_ttl)
+book_cache = result_cache.TTLCache(int(os.environ.get('blf_cache_book_size', 1024)), cache_ttl)
+
+def clear_caches(version=None):
+    loc_cache.clear()
+    book_cache.clear()
+
+model_registry.registry.on_reload(clear_caches)
+
+def cache_stats():
+    return {'location': loc_cache.stats(), 'book': book_cache.stats()}
+
+def rank_ratings(rows, N=5, mu=3, k=5):
+    ''' Rank books by Bayes sum of their ratings.
+        Args: rows (list of (blf_book_id, user_id, book_rating) tuples), N, mu (prior), k (number of books)
+        Returns: list of the k blf_book_ids with the highest Bayes sum
+    '''
+    if not rows:
+        return []
+    book_ids, user_ids, ratings = zip(*rows)
+    return scoring.bayes_top(np.array(book_ids), np.array(ratings, dtype=float), k, N, mu)
+
+def model_user_ids(model):
+    '''user_id of every row of the feature matrix (sorted).'''
+    if model.get('user_ids') is not None:
+        return model['user_ids']
+    return np.asarray(model['by_user_ratings'].index, dtype=str)
 
 def get_books(id_list):
     '''Get books from PostgreSQL database based on list of blf_book_ids
        Args: id_list - list of blf_book_ids recommended
-       Returns: Pandas Data Frame with book details'''
-    params = {'id_list': tuple(id_list)}
+       Returns: list of dictionaries with book details, in id_list order'''
+    id_list = [int(id) for id in id_list]
+    params = (id_list,)
     print(params)
 
-    conn = None
-    error = None
-    updated_rows = 0
-
-    try:
-        # Open connection to database
-        conn = psycopg2.connect(sql_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        # select only users from that location
-        query = """SELECT blf_book_id, title, cover, authors, pub_year, publisher, image_m
-                    FROM books 
-                    WHERE blf_book_id in %(id_list)s"""
-        cursor.execute(query, params)
-        book_dict = cursor.fetchall()
-        updated_rows = cursor.rowcount
-        conn.close()
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    
-    finally:
-        if conn is not None:
-            conn.close()
-        if error:
-            exit(0)
-    
-    books = pd.DataFrame(book_dict)
-    return books
+    # select only the recommended books
+    book_dict = db.query('books_by_id', params)
+
+    rank = {id: i for i, id in enumerate(id_list)}
+    return sorted(book_dict, key=lambda book: rank[book['blf_book_id']])
 
 def get_similar_users(location):
     '''Find all users with a location containing the string entered in the form field -- future plan 
         is to autopopulate field as the person types to reduce the possibility of no match.'''
+    # Use the in-memory location index when it was built, otherwise query the database
+    location_index = model_registry.get_model().get('location_index')
+    if location_index is not None:
+        return location_index.users(location).tolist()
+
     # Define query parameters
-    params = {'location': location+'%'}
-
-    conn = None
-    error = None
-    updated_rows = 0
-
-    try:
-        # Open connection to database
-        conn = psycopg2.connect(sql_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        # select only users from that location
-        query = "SELECT * FROM users WHERE location LIKE %(location)s"
-        cursor.execute(query, params)
-        # print(cursor.query)
-        user_dict = cursor.fetchall()
-        updated_rows = cursor.rowcount
-        conn.close()
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    
-    finally:
-        if conn is not None:
-            conn.close()
-        if error:
-            exit(0)
+    params = (location+'%',)
 
-    sim_users = pd.DataFrame(user_dict)
-    sim_users.set_index('user_id', inplace=True)
+    # select only users from that location
+    user_rows = db.query('users_by_location', params, dict_rows=False)
 
-    return sim_users
+    return [user_id for user_id, user_location in user_rows]
 
+@result_cache.cached(loc_cache, lambda location: (model_registry.get_model().version, location))
 def get_recs_by_loc(location):
     ''' At the moment this function always returns the same list of books for any user in that location
         Future plan: the book entered will also be part of the recommendation.
-        Args: user (Pandas data frame), ratings (Pandas data frame), userid (int)
-        Returns: Pandas data frame with the top 5 books rated for the location.
+        Args: location (string)
+        Returns: list of the blf_book_ids of the top 5 books rated for the location.
     '''
-    df_sim_users = get_similar_users(location)
-    params = {'users': tuple(df_sim_users.index.to_list())}
-    conn = None
-    error = None
-    updated_rows = 0
-
-    try:
-        conn = psycopg2.connect(sql_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        query = "SELECT blf_book_id, user_id, book_rating FROM ratings WHERE user_id in %(users)s"
-        cursor.execute(query, params)
-        ratings_dict = cursor.fetchall()
-        updated_rows = cursor.rowcount
-        conn.close()
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    
-    finally:
-        if conn is not None:
-            conn.close()
-        if error:
-            exit(0)
+    # Precomputed rankings for the location, when built
+    if loc_recs_source == 'precomputed':
+        rankings = model_registry.get_model().get('location_rankings')
+        book_ids = rankings.lookup(location) if rankings is not None else None
+        if book_ids is not None:
+            return book_ids
 
-    # Filter df_ratings by only the "closest" users
-    sim_user_ratings = pd.DataFrame(ratings_dict)
-    print(sim_user_ratings.head())
-    ratings_grp_mult = sim_user_ratings.groupby('blf_book_id')['book_rating']
+    sim_users = get_similar_users(location)
 
-    # Calculate Bayes sum for user ratings and return top 5 books based on Bayes sum
-    return ratings_grp_mult.aggregate(bayes_sum(5,3)).sort_values(ascending = False).head().index.tolist()
+    if aggregation == 'sql':
+        params = (sim_users, 5, 3, 5)
+        return [book_id for book_id, score in db.query('top_books_by_users', params, dict_rows=False)]
+
+    params = (sim_users,)
 
+    # Ratings of only the "closest" users
+    sim_user_ratings = db.query('ratings_by_users', params, dict_rows=False)
+    print(len(sim_user_ratings), 'ratings')
+
+    # Calculate Bayes sum for user ratings and return top 5 books based on Bayes sum
+    return rank_ratings(sim_user_ratings, 5, 3)
+
+def query_neighbors(nn, features, rows, n_neighbors=20, mode=None):
+    ''' Find the nearest neighbors of a group of users with one batched query instead of a query per user.
+        Args: nn (fitted NearestNeighbors or LSHNearestNeighbors), features (sparse feature matrix),
+              rows (feature rows of the group), n_neighbors (int),
+              mode ('centroid': query with the average normalized vector of the group,
+                    'chunked': query every user, at most max_query_users, in chunks and keep the overall closest)
+        Returns: array of feature rows of the neighbors, closest first
+    '''
+    mode = mode or knn_query_mode
+    if len(rows) == 0:
+        return np.empty(0, dtype=int)
+
+    if mode == 'centroid':
+        centroid = sparse.csr_matrix(normalize_rows(features[rows]).mean(axis=0))
+        # The group's own users are the closest to its centroid: ask for enough neighbors to drop them all
+        dists, indices = nn.kneighbors(centroid, n_neighbors=min(n_neighbors + len(rows), features.shape[0]))
+        return indices[0][~np.isin(indices[0], rows)][:n_neighbors]
+
+    # Spread the sample over the whole group rather than whoever happens to come first
+    if len(rows) > max_query_users:
+        rows = rows[np.linspace(0, len(rows) - 1, max_query_users).astype(int)]
+
+    all_dists, all_indices = [], []
+    for start in range(0, len(rows), query_chunk_size):
+        chunk = rows[start:start + query_chunk_size]
+        # One extra neighbor per query because each user is its own closest match
+        dists, indices = nn.kneighbors(features[chunk], n_neighbors=n_neighbors + 1)
+        not_self = indices != chunk[:, None]
+        all_dists.append(dists[not_self])
+        all_indices.append(indices[not_self])
+    dists = np.concatenate(all_dists)
+    indices = np.concatenate(all_indices)
+
+    # Keep each neighbor's smallest distance, then the n_neighbors smallest overall
+    order = np.lexsort((dists, indices))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = indices[order][1:] != indices[order][:-1]
+    indices, dists = indices[order][first], dists[order][first]
+    if len(indices) > n_neighbors:
+        top = np.argpartition(dists, n_neighbors - 1)[:n_neighbors]
+        indices, dists = indices[top], dists[top]
+    return indices[np.argsort(dists, kind='stable')]
+
+@result_cache.cached(book_cache, lambda blf_book_id, title: (model_registry.get_model().version, blf_book_id, title))
 def get_recs_by_user(blf_book_id,title):
     ''' Uses K-Nearest Neighbors to get the top 5 books based on other users who have highly rated the same book.
-        Args: users (Pandas Data Frame), ratings (Pandas Data Frame), userid (int), isbn (string)
-        Return: Pandas Data Frame with 5 recommended books
+        Args: blf_book_id (int), title (string)
+        Return: list of the blf_book_ids of 5 recommended books
     '''
     # Set value of rating for book to 5, since the form asks for 5 star book 
     rating = 5.0
 
+    # Get the model loaded in this worker (ratings by user, feature matrix, fitted kNN...)
+    model = model_registry.get_model()
+
+    # Precomputed "readers also liked" table, when selected and built
+    if book_recs_source == 'item' and model.get('item_similarity') is not None:
+        return model['item_similarity'].similar(blf_book_id)
+
     # Create params for SQL query
-    params = {'blf_book_id': blf_book_id, 'book_rating': rating}
+    params = (blf_book_id, rating)
     print(params)
 
-    error = None
-    conn = None
-    updated_rows = 0
-
     # Find all similar users who rated this book a 5
-    # Start with connection to the database
-    try:
-        conn = psycopg2.connect(sql_url)
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-
-        query = "SELECT user_id FROM ratings WHERE blf_book_id = %(blf_book_id)s and book_rating = %(book_rating)s"
-        cursor.execute(query, params)
-        ratings_dict = cursor.fetchall()
-
-        sim_user_ratings = pd.DataFrame(ratings_dict)
-        print(sim_user_ratings)
-
-        # Get ratings (as dictionary) for the user with the max number of reviewed books
-        by_user_ratings = joblib.load('by_user_ratings.pkl')
-        features = joblib.load('features.pkl')
-
-        sim_user_features = features[by_user_ratings.index.get_indexer(by_user_ratings[by_user_ratings.index.isin(sim_user_ratings['user_id'].tolist())].index.tolist())]
-
-        # Load the model from the file
-        nn = joblib.load('nn.pkl')
-        
-        # Use the loaded model to make predictions
-        dists, indices = nn.kneighbors(sim_user_features)
-        neighbors = [by_user_ratings.index[i] for i in indices[0]][1:]
-
-        params = {'neighbors': tuple(neighbors), 'blf_book_id': blf_book_id, 'title': title}
-        print(neighbors)
-        query = """SELECT * 
-                   FROM ratings 
-                   INNER JOIN books using (blf_book_id)
-                   WHERE user_id IN %(neighbors)s and blf_book_id != %(blf_book_id)s and title !=%(title)s"""
-        cursor.execute(query, params)
-        ratings_grp_dict = cursor.fetchall()
-        updated_rows = cursor.rowcount
-        ratings_grp = pd.DataFrame(ratings_grp_dict).groupby('blf_book_id')['book_rating']
-        
-        conn.close()
-
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
+    sim_users = np.array([user_id for user_id, in db.query('raters_by_book', params, dict_rows=False)], dtype=str)
+    print(len(sim_users), 'users rated the book a 5')
+
+    user_ids = model_user_ids(model)
+    features = model['features']
+
+    # Rows of the feature matrix for the users who rated the book a 5 (user_ids is sorted)
+    sim_user_rows = np.searchsorted(user_ids, sim_users)
+    sim_user_rows = np.unique(sim_user_rows[user_ids[np.minimum(sim_user_rows, len(user_ids) - 1)] == sim_users])
+
+    # Approximate nearest neighbors when selected and built, otherwise exact brute force
+    nn = model['nn']
+    if knn_backend == 'ann' and model.get('ann') is not None:
+        nn = model['ann']
     
-    finally:
-        if conn is not None:
-            conn.close()
-        if error:
-            exit(0)
+    # Use the loaded model to find the users closest to the 5 star raters
+    indices = query_neighbors(nn, features, sim_user_rows)
+    neighbors = user_ids[indices].tolist()
+
+    print(neighbors)
+    if aggregation == 'sql':
+        params = (neighbors, blf_book_id, title, 5, 3, 5)
+        return [book_id for book_id, score in db.query('top_neighbor_books', params, dict_rows=False)]
+
+    params = (neighbors, blf_book_id, title)
+    neighbor_ratings = db.query('neighbor_ratings', params, dict_rows=False)
 
     # Calculate bayes sum aggregation on ratings
-    return ratings_grp.aggregate(bayes_sum(5,3)).sort_values(ascending = False).head().index.tolist()
\ No newline at end of file
+    return rank_ratings(neighbor_ratings, 5, 3)
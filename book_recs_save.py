@@ -1,24 +1,35 @@
+import ann_index
 import argparse
-import joblib
+import item_similarity
+import model_registry
 import pandas as pd
-from sklearn import base
-from sklearn.feature_extraction import DictVectorizer
+import time
+import training
 from sklearn.neighbors import NearestNeighbors
 
 def save_model(df_ratings):
-    ''' Uses K-Nearest Neighbors to get the top 5 books based on other users who have highly rated the same book.
-        Args: users (Pandas Data Frame), ratings (Pandas Data Frame), userid (int), isbn (string)
-        Return: Pandas Data Frame with 5 recommended books
+    ''' Fits the K-Nearest Neighbors models and item similarity table used for book recommendations
+        and publishes them as a new model version (merge_data calls it after merging the ratings).
+        Args: ratings (Pandas Data Frame)
     '''
-
-    # Get ratings (as dictionary) for the user with the max number of reviewed books
-    by_user_ratings = df_ratings.groupby('user_id').apply(
-        lambda items: {i[6]: i[3] for i in items.itertuples()})
-    features = DictVectorizer().fit_transform(by_user_ratings)
+    time1 = time.perf_counter()
+    # Users x books ratings matrix, with the user_id of each row and blf_book_id of each column
+    features, user_ids, book_ids = training.rating_matrix(df_ratings)
+    training.report('rating matrix', time1)
 
     # Use K Nearest Neighbors to identify top 5 books
     nn = NearestNeighbors(n_neighbors=20, metric='cosine', algorithm='brute').fit(features)
-    joblib.dump(nn, 'nn.pkl')
+
+    # Approximate index for the website (brute force nn is kept for comparison, see ann_index.py)
+    ann = ann_index.LSHNearestNeighbors(n_neighbors=20).fit(features, book_ids)
+
+    # Top co-liked books for every book, so "readers also liked" is a lookup
+    item_sim = item_similarity.build(features, book_ids)
+
+    # Publish as a new model version, running websites pick it up without a restart
+    model_registry.publish({'nn': nn, 'ann': ann, 'features': features, 'book_ids': book_ids, 'user_ids': user_ids,
+                            'item_similarity': item_sim}, remove=['by_user_ratings'])
+    training.report('training', time1)
 
 
 def main():
@@ -0,0 +1,61 @@
+import io
+import time
+
+# Indexes built on the staging table before it is swapped in, for the queries in db.STATEMENTS.
+# table: list of (index name suffix, indexed columns)
+INDEXES = {
+    'books': [('blf_book_id', 'blf_book_id'), ('title', 'title')],
+    'users': [('user_id', 'user_id'), ('location', 'location text_pattern_ops')],
+    'ratings': [('user_id', 'user_id'), ('blf_book_id', 'blf_book_id, book_rating')],
+}
+
+# Rows serialized to CSV per COPY batch, so the whole table is never held as text
+copy_chunk_size = 200000
+
+def load_table(engine, df, table, indexes=None, chunk_size=copy_chunk_size):
+    ''' Replace a table with the rows of a data frame without leaving it missing or half loaded:
+        the rows are streamed with COPY FROM STDIN into <table>_staging, indexed and analyzed there,
+        and then renamed over the old table in one transaction.
+        Args: engine (sqlalchemy engine), df (Pandas Data Frame), table (table name),
+              indexes (list of (name suffix, columns), defaults to INDEXES[table])
+        Returns: rows per second
+    '''
+    staging = table + '_staging'
+    indexes = INDEXES.get(table, []) if indexes is None else indexes
+    time1 = time.perf_counter()
+
+    # Empty staging table with the column types to_sql would have used
+    df.head(0).to_sql(name=staging, con=engine, if_exists='replace', index=False)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        columns = ', '.join(f'"{column}"' for column in df.columns)
+        for start in range(0, len(df), chunk_size):
+            buffer = io.StringIO()
+            df.iloc[start:start + chunk_size].to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            cursor.copy_expert(f'COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+        for name, indexed in indexes:
+            cursor.execute(f'CREATE INDEX {staging}_{name}_idx ON {staging} ({indexed})')
+        cursor.execute(f'ANALYZE {staging}')
+        conn.commit()
+
+        # Swap: readers see either the old table or the new one
+        cursor.execute(f'DROP TABLE IF EXISTS {table}_old')
+        cursor.execute(f'ALTER TABLE IF EXISTS {table} RENAME TO {table}_old')
+        cursor.execute(f'ALTER TABLE {staging} RENAME TO {table}')
+        cursor.execute(f'DROP TABLE IF EXISTS {table}_old')
+        for name, indexed in indexes:
+            cursor.execute(f'ALTER INDEX {staging}_{name}_idx RENAME TO {table}_{name}_idx')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    seconds = time.perf_counter() - time1
+    rows_per_second = len(df) / seconds if seconds else float('inf')
+    print(f'{table}: {len(df)} rows in {seconds:.1f} s ({rows_per_second:.0f} rows/s)')
+    return rows_per_second
@@ -0,0 +1,273 @@
+import argparse
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+import scoring
+
+# Book columns returned by books_by_id (same as db.STATEMENTS)
+BOOK_COLUMNS = ['title', 'cover', 'authors', 'publisher', 'image_m']
+
+class StringColumn:
+    ''' Read-only column of strings stored as one utf-8 byte array and the offsets of each string in it.'''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @staticmethod
+    def save(path, strings):
+        encoded = [s.encode('utf-8') if isinstance(s, str) else b'' for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        np.save(path + '.offsets.npy', offsets)
+        np.save(path + '.data.npy', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    @classmethod
+    def open(cls, path):
+        return cls(np.load(path + '.data.npy', mmap_mode='r'), np.load(path + '.offsets.npy', mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+def _bisect(column, order, text, prefix=False):
+    ''' Positions lo, hi in order (positions of column in sorted order, None if column is sorted) of the strings
+        equal to text, or starting with it if prefix. Only log(n) strings are decoded.'''
+    def first(key, after):
+        lo, hi = 0, len(order) if order is not None else len(column)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = column[order[mid] if order is not None else mid]
+            if prefix and after:
+                value = value[:len(key)]
+            if value < key or (after and value == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    return first(text, False), first(text, True)
+
+def _sorted_strings(strings, positions=None):
+    # Order that sorts the strings (or only those at positions), as Python compares them (what _bisect expects)
+    positions = range(len(strings)) if positions is None else positions
+    return np.array(sorted(positions, key=strings.__getitem__), dtype=np.int32)
+
+def write(ratings, users, books, directory):
+    ''' Write the ratings, users and books tables as memory mappable NumPy arrays.
+        Users and books get dense int codes (positions in the sorted user_ids and book_ids), ratings are stored
+        twice, grouped by user and grouped by book, with offset arrays so a user's or a book's ratings are
+        one slice. Longer strings (locations, titles...) are stored as StringColumns.
+        Args: ratings (Pandas Data Frame with user_id, blf_book_id, book_rating),
+              users (Pandas Data Frame with user_id and location),
+              books (Pandas Data Frame with blf_book_id and BOOK_COLUMNS, pub_year)
+        Returns: ColumnarStore
+    '''
+    os.makedirs(directory, exist_ok=True)
+    ratings = ratings.dropna(subset=['user_id', 'blf_book_id'])
+    books = books.dropna(subset=['blf_book_id']).drop_duplicates('blf_book_id').sort_values('blf_book_id')
+    users = users.dropna(subset=['user_id']).drop_duplicates('user_id')
+
+    user_ids = np.unique(np.concatenate([users['user_id'].to_numpy(dtype=str), ratings['user_id'].to_numpy(dtype=str)]))
+    book_ids = books['blf_book_id'].to_numpy(dtype=np.int64)
+    ratings = ratings[ratings['blf_book_id'].isin(book_ids)]
+    user_codes = np.searchsorted(user_ids, ratings['user_id'].to_numpy(dtype=str)).astype(np.int32)
+    book_codes = np.searchsorted(book_ids, ratings['blf_book_id'].to_numpy(dtype=np.int64)).astype(np.int32)
+    values = ratings['book_rating'].to_numpy(dtype=np.float32)
+
+    arrays = {'user_ids': user_ids, 'book_ids': book_ids,
+              'pub_year': books['pub_year'].fillna(0).to_numpy(dtype=np.int32) if 'pub_year' in books else
+                          np.zeros(len(books), dtype=np.int32)}
+    for by, codes, other, n in [('user', user_codes, book_codes, len(user_ids)),
+                                ('book', book_codes, user_codes, len(book_ids))]:
+        order = np.lexsort((other, codes))
+        arrays[f'by_{by}_offsets'] = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=n)))).astype(np.int64)
+        arrays[f'by_{by}_{"books" if by == "user" else "users"}'] = other[order]
+        arrays[f'by_{by}_ratings'] = values[order]
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), array)
+
+    locations = users.set_index('user_id')['location'].reindex(user_ids).to_numpy(dtype=object)
+    columns = {'locations': locations}
+    columns.update({column: books[column].to_numpy(dtype=object) if column in books else [''] * len(books)
+                    for column in BOOK_COLUMNS})
+    for name, strings in columns.items():
+        StringColumn.save(os.path.join(directory, name), strings)
+
+    store = ColumnarStore(directory)
+    # Users without a location are stored as '' but left out of the location order, so that like NULL in SQL
+    # no LIKE pattern matches them
+    has_location = [i for i, location in enumerate(locations) if isinstance(location, str)]
+    np.save(os.path.join(directory, 'location_order.npy'), _sorted_strings(store.locations, has_location))
+    np.save(os.path.join(directory, 'title_order.npy'), _sorted_strings(store.title))
+    return ColumnarStore(directory)
+
+class ColumnarStore:
+    ''' Read-only ratings, users and books tables written by write(), opened as memory maps so every
+        gunicorn worker shares one copy through the page cache. execute() answers the same statements as
+        db.execute, so book_recs_pred can use either backend.
+        Pickles as its directory only, so it can be published with the model.'''
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._open()
+
+    def _open(self):
+        path = lambda name: os.path.join(self.directory, name)
+        for name in ['user_ids', 'book_ids', 'pub_year', 'by_user_offsets', 'by_user_books', 'by_user_ratings',
+                     'by_book_offsets', 'by_book_users', 'by_book_ratings', 'location_order', 'title_order']:
+            if os.path.exists(path(name + '.npy')):
+                setattr(self, name, np.load(path(name + '.npy'), mmap_mode='r'))
+        for name in ['locations'] + BOOK_COLUMNS:
+            setattr(self, name, StringColumn.open(path(name)))
+
+    def __getstate__(self):
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.directory = state['directory']
+        self._open()
+
+    def book_code(self, blf_book_id):
+        pos = np.searchsorted(self.book_ids, blf_book_id)
+        return int(pos) if pos < len(self.book_ids) and self.book_ids[pos] == blf_book_id else None
+
+    def _user_codes(self, user_ids):
+        # Codes of the known user_ids, each once as with user_id = ANY($1) (self.user_ids is a sorted fixed
+        # width string array)
+        user_ids = np.unique(np.asarray(user_ids, dtype=str))
+        codes = np.searchsorted(self.user_ids, user_ids)
+        known = codes < len(self.user_ids)
+        known[known] = self.user_ids[codes[known]] == user_ids[known]
+        return codes[known].astype(np.int64)
+
+    def _ratings_by_users(self, user_codes):
+        # (book codes, user codes, ratings) of all the ratings of the users
+        starts, ends = self.by_user_offsets[user_codes], self.by_user_offsets[user_codes + 1]
+        lengths = ends - starts
+        # Concatenated ranges start:end without a Python loop
+        positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return (np.asarray(self.by_user_books[positions]), np.repeat(user_codes, lengths),
+                np.asarray(self.by_user_ratings[positions], dtype=np.float64))
+
+    def _neighbor_ratings(self, user_ids, blf_book_id, title):
+        book_codes, user_codes, ratings = self._ratings_by_users(self._user_codes(user_ids))
+        lo, hi = _bisect(self.title, self.title_order, title)
+        code = self.book_code(blf_book_id)
+        excluded = np.append(np.asarray(self.title_order[lo:hi]), -1 if code is None else code)
+        keep = ~np.isin(book_codes, excluded)
+        return book_codes[keep], user_codes[keep], ratings[keep]
+
+    def books(self, blf_book_ids):
+        rows = []
+        for blf_book_id in blf_book_ids:
+            code = self.book_code(blf_book_id)
+            if code is not None:
+                book = {'blf_book_id': int(self.book_ids[code])}
+                book.update({column: getattr(self, column)[code] for column in BOOK_COLUMNS})
+                book['pub_year'] = int(self.pub_year[code]) or None
+                rows.append(book)
+        return rows
+
+    def execute(self, name, params, dict_rows=True):
+        ''' Answer one of the db.STATEMENTS from the arrays.
+            Args: name (key of db.STATEMENTS), params (tuple of arguments in $1, $2... order),
+                  dict_rows (return rows as dictionaries instead of tuples)
+            Returns: list of rows
+        '''
+        if name == 'books_by_id':
+            rows = self.books(params[0])
+            columns = ['blf_book_id', 'title', 'cover', 'authors', 'pub_year', 'publisher', 'image_m']
+            return rows if dict_rows else [tuple(row[column] for column in columns) for row in rows]
+
+        if name == 'users_by_location':
+            # Only the LIKE 'prefix%' patterns sent by get_similar_users
+            prefix = params[0][:-1] if params[0].endswith('%') else params[0]
+            lo, hi = _bisect(self.locations, self.location_order, prefix, prefix=params[0].endswith('%'))
+            codes = np.sort(np.asarray(self.location_order[lo:hi]))
+            columns = ['user_id', 'location']
+            rows = [(str(self.user_ids[code]), self.locations[code]) for code in codes]
+
+        elif name == 'ratings_by_users':
+            book_codes, user_codes, ratings = self._ratings_by_users(self._user_codes(params[0]))
+            columns = ['blf_book_id', 'user_id', 'book_rating']
+            rows = list(zip(self.book_ids[book_codes].tolist(), self.user_ids[user_codes].tolist(), ratings.tolist()))
+
+        elif name == 'raters_by_book':
+            code = self.book_code(params[0])
+            columns = ['user_id']
+            rows = []
+            if code is not None:
+                start, end = self.by_book_offsets[code], self.by_book_offsets[code + 1]
+                raters = self.by_book_users[start:end][self.by_book_ratings[start:end] == params[1]]
+                rows = [(user_id,) for user_id in self.user_ids[raters].tolist()]
+
+        elif name == 'neighbor_ratings':
+            book_codes, user_codes, ratings = self._neighbor_ratings(*params)
+            columns = ['blf_book_id', 'user_id', 'book_rating']
+            rows = list(zip(self.book_ids[book_codes].tolist(), self.user_ids[user_codes].tolist(), ratings.tolist()))
+
+        elif name in ('top_books_by_users', 'top_neighbor_books'):
+            if name == 'top_books_by_users':
+                user_ids, N, mu, k = params
+                book_codes, user_codes, ratings = self._ratings_by_users(self._user_codes(user_ids))
+            else:
+                user_ids, blf_book_id, title, N, mu, k = params
+                book_codes, user_codes, ratings = self._neighbor_ratings(user_ids, blf_book_id, title)
+            groups, sums, counts = scoring.group_stats(book_codes, ratings)
+            scores = scoring.bayes_scores(sums, counts, N, mu)
+            top = scoring.top_k(np.arange(len(groups)), scores, k)
+            columns = ['blf_book_id', 'score']
+            rows = [(int(self.book_ids[groups[i]]), float(scores[i])) for i in top]
+
+        elif name == 'book_id_by_title':
+            lo, hi = _bisect(self.title, self.title_order, params[0])
+            columns = ['blf_book_id']
+            rows = []
+            for code in np.sort(np.asarray(self.title_order[lo:hi])):
+                start, end = self.by_book_offsets[code], self.by_book_offsets[code + 1]
+                if (self.by_book_ratings[start:end] == 5.0).any():
+                    rows = [(int(self.book_ids[code]),)]
+                    break
+
+        else:
+            raise KeyError(name)
+
+        return [dict(zip(columns, row)) for row in rows] if dict_rows else rows
+
+def new_directory(model_dir=None):
+    '''Directory for a new store: <model directory>/stores/<timestamp>.'''
+    import model_registry
+    return os.path.join(model_dir or model_registry.model_dir, 'stores', datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+def publish(ratings, users, books, directory=None):
+    ''' Write a new store under <model directory>/stores and publish it with the model as ratings_store,
+        so workers switch to it with the next model version.
+        Returns: ColumnarStore
+    '''
+    import model_registry
+    directory = directory or new_directory()
+    time1 = time.perf_counter()
+    store = write(ratings, users, books, directory)
+    model_registry.publish({'ratings_store': store})
+    print('columnar store written to', directory, 'in', round(time.perf_counter() - time1, 1), 's')
+    return store
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=str, default='books_final.csv')
+    parser.add_argument('--ratings', type=str, default='ratings_final.csv')
+    parser.add_argument('--users', type=str, default='users_final.csv')
+    args = parser.parse_args()
+
+    import pandas as pd
+    books = pd.read_csv(args.books, dtype={'pub_year': 'Int64', 'original_title': str, 'lang': str})
+    ratings = pd.read_csv(args.ratings, usecols=['blf_book_id', 'user_id', 'book_rating'],
+                          dtype={'blf_book_id': 'Int32', 'user_id': str, 'book_rating': 'Float32'})
+    users = pd.read_csv(args.users, usecols=['user_id', 'location'], dtype=str)
+    publish(ratings, users, books)
+
+if __name__ == '__main__':
+    main()
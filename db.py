@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import connection as _connection
+from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+import model_registry
+
+sql_url = os.environ.get('blf_sql')
+
+# Where the website's read queries go: 'postgres', or 'columnar' for the memory mapped
+# columnar_store.ColumnarStore published with the model (merge_data --store Yes), which needs no database
+backend = os.environ.get('blf_backend', 'postgres')
+
+# Pool size is per process, so the total number of connections is (max x gunicorn workers)
+pool_min = int(os.environ.get('blf_sql_pool_min', 1))
+pool_max = int(os.environ.get('blf_sql_pool_max', 4))
+
+# Seconds a request waits for a free connection before giving up with PoolError
+checkout_timeout = float(os.environ.get('blf_sql_checkout_timeout', 10))
+
+# Connections idle for longer than this (seconds) are pinged with SELECT 1 before being handed out
+health_interval = float(os.environ.get('blf_sql_health_interval', 30))
+
+# Fixed queries used by the website, prepared once per connection and then run with EXECUTE.
+# name: (argument types, query)
+STATEMENTS = {
+    'books_by_id': ('bigint[]',
+                    """SELECT blf_book_id, title, cover, authors, pub_year, publisher, image_m
+                       FROM books
+                       WHERE blf_book_id = ANY($1)"""),
+    'users_by_location': ('text',
+                          """SELECT user_id, location
+                             FROM users
+                             WHERE location LIKE $1"""),
+    'ratings_by_users': ('text[]',
+                         """SELECT blf_book_id, user_id, book_rating
+                            FROM ratings
+                            WHERE user_id = ANY($1)"""),
+    'raters_by_book': ('bigint, double precision',
+                       """SELECT user_id
+                          FROM ratings
+                          WHERE blf_book_id = $1 and book_rating = $2"""),
+    'neighbor_ratings': ('text[], bigint, text',
+                         """SELECT blf_book_id, user_id, book_rating
+                            FROM ratings
+                            INNER JOIN books using (blf_book_id)
+                            WHERE user_id = ANY($1) and blf_book_id != $2 and title != $3"""),
+    # Bayes sum (sum + mu*N) / (count + N) computed in the database, so only the top k rows are returned.
+    # NULL ratings count for neither, as with the pandas sum and count
+    'top_books_by_users': ('text[], double precision, double precision, integer',
+                           """SELECT blf_book_id, (coalesce(sum(book_rating), 0) + $3*$2) / (count(book_rating) + $2) AS score
+                              FROM ratings
+                              WHERE user_id = ANY($1)
+                              GROUP BY blf_book_id
+                              ORDER BY score DESC, blf_book_id
+                              LIMIT $4"""),
+    'top_neighbor_books': ('text[], bigint, text, double precision, double precision, integer',
+                           """SELECT blf_book_id, (coalesce(sum(book_rating), 0) + $5*$4) / (count(book_rating) + $4) AS score
+                              FROM ratings
+                              INNER JOIN books using (blf_book_id)
+                              WHERE user_id = ANY($1) and blf_book_id != $2 and title != $3
+                              GROUP BY blf_book_id
+                              ORDER BY score DESC, blf_book_id
+                              LIMIT $6"""),
+    'book_id_by_title': ('text',
+                         """SELECT blf_book_id
+                            FROM books
+                            INNER JOIN ratings using(blf_book_id)
+                            WHERE book_rating=5.0 AND title LIKE $1 ESCAPE ''
+                            ORDER BY blf_book_id
+                            LIMIT 1"""),
+}
+
+class PreparedConnection(_connection):
+    ''' psycopg2 connection that remembers which statements were prepared on it and when it was last used.'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.last_used = time.monotonic()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises when it runs out of connections, so threads wait here for a free one instead
+_slots = threading.BoundedSemaphore(pool_max)
+_stats = {'checkouts': 0, 'reconnects': 0, 'errors': 0, 'prepares': 0, 'executes': 0}
+# Per statement: number of executes, rows returned and total seconds (to compare the app and SQL aggregation)
+_statement_stats = {name: {'executes': 0, 'rows': 0, 'seconds': 0.0} for name in STATEMENTS}
+
+def get_pool():
+    '''Create the connection pool for this process on first use (gunicorn forks workers after import,
+       so the pool is recreated if the process id changes).'''
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ThreadedConnectionPool(pool_min, pool_max, sql_url, connection_factory=PreparedConnection)
+                _pool_pid = os.getpid()
+    return _pool
+
+def _is_alive(conn):
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout():
+    pool = get_pool()
+    if not _slots.acquire(timeout=checkout_timeout):
+        raise PoolError(f'no free connection after {checkout_timeout} s')
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+    _stats['checkouts'] += 1
+
+    # Replace connections that were closed by the server or fail the health check
+    if conn.closed or (time.monotonic() - conn.last_used > health_interval and not _is_alive(conn)):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+        _stats['reconnects'] += 1
+    return conn
+
+def _checkin(conn, broken=False):
+    conn.last_used = time.monotonic()
+    try:
+        get_pool().putconn(conn, close=broken or bool(conn.closed))
+    finally:
+        _slots.release()
+
+def execute(name, params, dict_rows=True):
+    ''' Run one of the prepared STATEMENTS on a pooled connection.
+        Args: name (key of STATEMENTS), params (tuple of arguments in $1, $2... order),
+              dict_rows (return rows as dictionaries instead of tuples)
+        Returns: list of rows
+    '''
+    conn = _checkout()
+    broken = False
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor if dict_rows else None)
+        if name not in conn.prepared:
+            arg_types, query = STATEMENTS[name]
+            cursor.execute(f'PREPARE {name} ({arg_types}) AS {query}')
+            conn.prepared.add(name)
+            _stats['prepares'] += 1
+
+        placeholders = ', '.join(['%s'] * len(params))
+        time1 = time.perf_counter()
+        cursor.execute(f'EXECUTE {name} ({placeholders})', params)
+        rows = cursor.fetchall()
+        _stats['executes'] += 1
+        statement_stats = _statement_stats[name]
+        statement_stats['executes'] += 1
+        statement_stats['rows'] += len(rows)
+        statement_stats['seconds'] += time.perf_counter() - time1
+        conn.rollback()
+        return rows
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        _stats['errors'] += 1
+        # Drop the connection rather than guess what state its session (and prepared statements) is in
+        broken = True
+        raise
+
+    finally:
+        _checkin(conn, broken)
+
+def query(name, params, dict_rows=True):
+    ''' Run one of the STATEMENTS on the selected backend, falling back to PostgreSQL when the columnar
+        store has not been published. Same arguments as execute.'''
+    if backend == 'columnar':
+        store = model_registry.get_model().get('ratings_store')
+        if store is not None:
+            return store.execute(name, params, dict_rows)
+    return execute(name, params, dict_rows)
+
+def health_check():
+    '''Check that a pooled connection can reach the database (or the columnar store is loaded). Returns True/False.'''
+    if backend == 'columnar' and model_registry.get_model().get('ratings_store') is not None:
+        return True
+    try:
+        conn = _checkout()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return False
+    alive = _is_alive(conn)
+    _checkin(conn, broken=not alive)
+    return alive
+
+def pool_stats():
+    '''Pool size and usage counters for this process.'''
+    stats = dict(_stats)
+    stats['pid'] = os.getpid()
+    stats['min'] = pool_min
+    stats['max'] = pool_max
+    stats['statements'] = {name: dict(counts) for name, counts in _statement_stats.items() if counts['executes']}
+    if _pool is not None and _pool_pid == os.getpid():
+        stats['in_use'] = len(_pool._used)
+        stats['idle'] = len(_pool._pool)
+    else:
+        stats['in_use'] = stats['idle'] = 0
+    return stats
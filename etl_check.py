@@ -0,0 +1,93 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import book_recs
+import merge_data
+
+# Row by row implementations the vectorized merge_data / book_recs stages replaced, kept to check them against
+
+def legacy_cover(df):
+    thumbnails = []
+    for index,row in df.iterrows():
+        thumbnails.append(f'<a href="/book/{row["blf_book_id"]}"><img src={row["image_s"]} alt={row["title"]}>')
+    return thumbnails
+
+def legacy_thumbnails(df):
+    thumbnails = []
+    for index,row in df.iterrows():
+        thumbnails.append(f'<a href="/book/{row["ISBN"]}"><img src={row["Image-URL-S"]} alt={row["Book-Title"]}>')
+    return thumbnails
+
+def legacy_user_ids(prefix, uids):
+    return uids.apply(lambda x: prefix+str(x).zfill(2) if pd.notnull(x) else x)
+
+def legacy_titlecase(titles):
+    return titles.apply(lambda x: merge_data.titlecase(x) if pd.notnull(x) else x)
+
+def legacy_isbn(isbns):
+    return isbns.apply(lambda x: x.strip().upper() if pd.notnull(x) else x)
+
+def fixture(n, seed=0):
+    ''' Books with the awkward cases seen in the BX and Goodreads data: accents, apostrophes, digits,
+        punctuation, lower case ISBN check digits, surrounding spaces and missing values.
+        Returns: Pandas Data Frame
+    '''
+    rng = np.random.default_rng(seed)
+    words = ['the', 'LORD', "o'brien's", 'café', 'of', 'rings', '1st', 'ÉCOLE', 'mcdonald', "don't", 'x-men',
+             'harry', 'potter', 'und', 'straße', 'vol.2', '(paperback)', 'ÆSOP', 'a', 'zoë']
+    # Mostly plain ASCII words, as in the real titles
+    weights = np.array([1 if word.isascii() and "'" not in word else 0.1 for word in words])
+    titles = [' '.join(rng.choice(words, rng.integers(1, 6), p=weights / weights.sum())) for _ in range(n)]
+    isbns = [(' ' if i % 7 == 0 else '') + '%09d' % rng.integers(0, 10**9) + rng.choice(['x', 'X', '1', '5'])
+             + (' ' if i % 5 == 0 else '') for i in range(n)]
+    books = pd.DataFrame({'blf_book_id': np.arange(1, n + 1), 'title': titles, 'isbn': isbns,
+                          'image_s': ['http://images.example.com/%d.jpg' % i for i in range(n)],
+                          'uid': rng.integers(0, 300000, n)})
+    missing = rng.random(n) < 0.01
+    books.loc[missing, ['title', 'isbn', 'image_s']] = None
+    return books
+
+def compare(name, legacy, vectorized):
+    ''' Time both implementations and diff their outputs.
+        Returns: dictionary with the stage, milliseconds for each and the number of differing rows
+    '''
+    time1 = time.perf_counter()
+    expected = pd.Series(legacy(), dtype=object)
+    legacy_ms = (time.perf_counter() - time1) * 1000
+    time1 = time.perf_counter()
+    result = pd.Series(vectorized(), dtype=object)
+    vectorized_ms = (time.perf_counter() - time1) * 1000
+    same = (result.values == expected.values) | (result.isna().values & expected.isna().values)
+    for i in np.flatnonzero(~same)[:5]:
+        print(name, 'differs:', repr(expected.iloc[i]), '!=', repr(result.iloc[i]))
+    return {'stage': name, 'legacy_ms': round(legacy_ms, 1), 'vectorized_ms': round(vectorized_ms, 1),
+            'rows': len(expected), 'differences': int((~same).sum())}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000, help='size of the generated fixture')
+    parser.add_argument('--books', type=str, help='books CSV (books_final.csv) to check instead of the fixture')
+    args = parser.parse_args()
+
+    books = pd.read_csv(args.books) if args.books else fixture(args.rows)
+    if 'uid' not in books:
+        books['uid'] = books['blf_book_id']
+    bx_books = books.rename(columns={'isbn': 'ISBN', 'title': 'Book-Title', 'image_s': 'Image-URL-S'})
+
+    results = [compare('cover', lambda: legacy_cover(books), lambda: merge_data.cover(books)),
+               compare('thumbnails', lambda: legacy_thumbnails(bx_books), lambda: book_recs.thumbnails(bx_books)),
+               compare('user_id', lambda: legacy_user_ids('BX', books['uid']),
+                       lambda: merge_data.prefixed_ids('BX', books['uid'])),
+               compare('titlecase', lambda: legacy_titlecase(books['title']),
+                       lambda: merge_data.titlecase_series(books['title'])),
+               compare('isbn', lambda: legacy_isbn(books['isbn']), lambda: merge_data.normalize_isbn(books['isbn']))]
+    for result in results:
+        print(result)
+    if any(result['differences'] for result in results):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,5 @@
-import os
-import psycopg2
-
-sql_url = os.environ.get('blf_sql')
+import db
+import model_registry
 
 # Add the new information (location) to the user database, receives dataframe and location, returns dataframe
 def add_user(df, location):
@@ -19,39 +17,25 @@ def get_isbn(df, book_title):
     return df[df['Book-Title']==book_title]['ISBN'].iloc[0]
 
 def get_blf_book_id(title):
-    
-    conn = None
-    error = None
-    updated_rows = 0
-
-    params = {'title':title}
-
-    try:
-        # Open connection to database
-        conn = psycopg2.connect(sql_url)
-        cursor = conn.cursor()
-
-        # select only users from that location
-        query = """SELECT blf_book_id 
-                   FROM books 
-                   INNER JOIN ratings using(blf_book_id) 
-                   WHERE book_rating=5.0 AND title LIKE %(title)s ESCAPE '' 
-                   ORDER BY blf_book_id 
-                   LIMIT 1"""
-        cursor.execute(query, params)
-        blf_book_id = cursor.fetchall()
-        updated_rows = cursor.rowcount
-        print(updated_rows,'rows updated!')
-
-        conn.close()
-        
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    
-    finally:
-        if conn is not None:
-            conn.close()
-        if error:
-            exit(0)
-    
-    return blf_book_id[0][0]
+    ''' Find the blf_book_id of a 5 star rated book with this title.
+        Uses the title index published with the model when there is one, otherwise the database.
+        Returns: blf_book_id, or None if there is no match
+    '''
+    title_index = model_registry.get_model().get('title_index')
+    if title_index is not None:
+        return title_index.best(title)
+
+    params = (title,)
+
+    # select the first book with that title which has been rated 5 stars
+    blf_book_id = db.query('book_id_by_title', params, dict_rows=False)
+    print(len(blf_book_id),'rows updated!')
+
+    return blf_book_id[0][0] if blf_book_id else None
+
+def get_title_candidates(title, k=10):
+    '''Ranked list of books (dictionaries with blf_book_id and title) with titles close to the one entered.'''
+    title_index = model_registry.get_model().get('title_index')
+    if title_index is None:
+        return []
+    return title_index.resolve(title, k)
@@ -1,8 +1,11 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import http_cache
 import json
 import os
 import re
+import scrape_store
 import time
 
 import selenium
@@ -11,6 +14,14 @@ from urllib.error import HTTPError
 import bs4
 import pandas as pd
 
+# lxml builds the tree several times faster than the pure Python html.parser, which stays the fallback
+try:
+    import lxml
+    html_parser = 'lxml'
+except ImportError:
+    html_parser = 'html.parser'
+# Processes parsing the stored pages
+parse_workers = int(os.environ.get('blf_parse_workers', os.cpu_count() or 1))
 
 # def get_all_lists(soup):
 
@@ -108,23 +119,23 @@ def get_top_5_other_editions(soup):
       other_editions.append(div.find('a')['href'])
     return other_editions
 
-def get_isbn(soup):
+def get_isbn(soup, text=None):
     try:
-        isbn = re.findall(r'nisbn: [0-9]{10}' , str(soup))[0].split()[1]
+        isbn = re.findall(r'nisbn: [0-9]{10}' , text or str(soup))[0].split()[1]
         return isbn
     except:
         return "isbn not found"
 
-def get_isbn13(soup):
+def get_isbn13(soup, text=None):
     try:
-        isbn13 = re.findall(r'nisbn13: [0-9]{13}' , str(soup))[0].split()[1]
+        isbn13 = re.findall(r'nisbn13: [0-9]{13}' , text or str(soup))[0].split()[1]
         return isbn13
     except:
         return "isbn13 not found"
 
 
-def get_rating_distribution(soup):
-    distribution = re.findall(r'renderRatingGraph\([\s]*\[[0-9,\s]+', str(soup))[0]
+def get_rating_distribution(soup, text=None):
+    distribution = re.findall(r'renderRatingGraph\([\s]*\[[0-9,\s]+', text or str(soup))[0]
     distribution = ' '.join(distribution.split())
     distribution = [int(c.strip()) for c in distribution.split('[')[1].split(',')]
     distribution_dict = {'5 Stars': distribution[0],
@@ -157,25 +168,47 @@ def get_id(url):
     pattern = re.compile("\/(\d+).")
     return pattern.search(url).group(1)
     
-def scrape_book(isbn,book_id):
+def fetch_page(url):
+    ''' Page from the HTTP cache, or fetched (waiting between requests) and cached
+        Args: url
+        Returns: html (bytes), final url (after the search redirects to the book page)
+    '''
+    cache = http_cache.get_cache()
+    cached = cache.get(url) if cache else None
+    if cached:
+        return cached
+
+    source = urlopen(url)
+    html = source.read()
+    time.sleep(3)
+    if cache:
+        cache.set(url, None, html, source.url)
+    return html, source.url
+
+def book_url(isbn, book_id):
     if isbn: # BX dataset only has ISBN. Most of the GR dataset also, but some... do not.
-        url = 'https://www.goodreads.com/search/?q=' + isbn
+        return 'https://www.goodreads.com/search/?q=' + isbn
         
     elif book_id: # GR dataset items missing ISBN
-        url = 'https://www.goodreads.com/book/show/' + book_id
+        return 'https://www.goodreads.com/book/show/' + book_id
 
-    source = urlopen(url)
-    soup = bs4.BeautifulSoup(source, 'html.parser')
-    time.sleep(3)
+def parse_book(html, final_url, parser=None):
+    ''' Book metadata from a Goodreads book page. The page is parsed once, and the regular expressions run on
+        the page text decoded once, instead of str(soup) re-serializing the whole tree for each of them.
+        Args: html (bytes), final_url (url after the search redirect), parser (BeautifulSoup parser, defaults to html_parser)
+        Returns: dictionary, or '' if it is not a book page
+    '''
+    soup = bs4.BeautifulSoup(html, parser or html_parser)
+    text = html.decode('utf-8', errors='replace') if isinstance(html, bytes) else html
 
     if soup.find('h1', {'id': 'bookTitle'}):
-        return {'goodreads_book_id':              get_id(source.url),
+        return {'goodreads_book_id':              get_id(final_url),
                 'book_title':           ' '.join(soup.find('h1', {'id': 'bookTitle'}).text.split()),
                 "book_series":          get_series_name(soup),
                 "book_series_uri":      get_series_uri(soup),
                 'top_5_other_editions': get_top_5_other_editions(soup),
-                'isbn':                 get_isbn(soup),
-                'isbn13':               get_isbn13(soup),
+                'isbn':                 get_isbn(soup, text),
+                'isbn13':               get_isbn13(soup, text),
                 'year_first_published': get_year_first_published(soup),
                 'authorlink':           soup.find('a', {'class': 'authorName'})['href'],
                 'author':               ' '.join(soup.find('span', {'itemprop': 'name'}).text.split()),
@@ -187,21 +220,47 @@ def scrape_book(isbn,book_id):
                 'num_ratings':          soup.find('meta', {'itemprop': 'ratingCount'})['content'].strip(),
                 'num_reviews':          soup.find('meta', {'itemprop': 'reviewCount'})['content'].strip(),
                 'average_rating':       soup.find('span', {'itemprop': 'ratingValue'}).text.strip(),
-                'rating_distribution':  get_rating_distribution(soup)}
+                'rating_distribution':  get_rating_distribution(soup, text)}
     else:
         return ''
 
-def condense_books(books_directory_path):
-
-    books = []
-    
-    # Look for all the files in the directory and if they contain "book-metadata," then load them all and condense them into a single file
-    for file_name in os.listdir(books_directory_path):
-        if file_name.endswith('.json') and not file_name.startswith('.') and file_name != "all_books.json" and "book-metadata" in file_name:
-            _book = json.load(open(books_directory_path + '/' + file_name, 'r')) #, encoding='utf-8', errors='ignore'))
-            books.append(_book)
-
-    return books
+def scrape_book(isbn,book_id):
+    html, final_url = fetch_page(book_url(isbn, book_id))
+    return parse_book(html, final_url)
+
+def parse_page(page):
+    ''' Parse one stored page (run in the worker processes).
+        Args: page (key, html, final_url)
+        Returns: key, book ('' if not a book page, None if parsing failed), error message
+    '''
+    key, html, final_url = page
+    try:
+        return key, parse_book(html, final_url), None
+    except Exception as e:
+        return key, None, f'{type(e).__name__}: {e}'
+
+def parse_pages(store, keys, workers=None):
+    ''' Parse stored pages with a process pool and add the books to the store, a batch at a time.
+        A page that fails to parse is reported and left unparsed, to be parsed again on the next run.
+        Args: store (scrape_store.ScrapeStore), keys (list of page keys), workers (processes, defaults to parse_workers)
+        Returns: number of pages parsed, dictionary of key: error
+    '''
+    errors = {}
+    parsed = 0
+    with ProcessPoolExecutor(max_workers=workers or parse_workers) as pool:
+        for start in range(0, len(keys), scrape_store.batch_size):
+            pages = list(store.pages(keys[start:start + scrape_store.batch_size]))
+            books = {}
+            for key, book, error in pool.map(parse_page, pages, chunksize=16):
+                if error:
+                    errors[key] = error
+                    print('parsing', key, 'failed:', error)
+                else:
+                    books[key] = book
+            store.add_many(books)
+            parsed += len(books)
+            print(f'{parsed} of {len(keys)} pages parsed, {len(errors)} errors')
+    return parsed, errors
 
 def main():
 
@@ -213,45 +272,48 @@ def main():
     parser.add_argument('--format', type=str, action="store", default="json",
                         dest="format", choices=["json", "csv"],
                         help="set file output format")
+    parser.add_argument('--parse_workers', type=int, help='processes parsing the fetched pages')
+    parser.add_argument('--reparse', type=str, default='No', help='Yes to parse every stored page again')
     args = parser.parse_args()
 
     df_books = pd.read_csv('books_final.csv')
 
     book_ids              = df_books[['ISBN','book_id']].values
-    books_already_scraped =  [file_name.replace('_book-metadata.json', '').split('-')[0] for file_name in os.listdir(args.output_directory_path) if file_name.endswith('.json') and not file_name.startswith('all_books')]
-    books_to_scrape       = [[isbn, book_id] for isbn, book_id in book_ids if isbn not in books_already_scraped]
+    # Store keyed by ISBN-book_id, like the file names of earlier runs
+    store                 = scrape_store.open_store(args.output_directory_path)
+    books_already_scraped = store.keys()
+    pages_fetched         = store.page_keys()
+    books_to_scrape       = [[isbn, book_id] for isbn, book_id in book_ids if str(isbn) + '-' + str(book_id) not in books_already_scraped
+                             and str(isbn) + '-' + str(book_id) not in pages_fetched]
     condensed_books_path   = args.output_directory_path + '/all_books'
 
+    # Fetch the raw pages into the store
     for i, bid in enumerate(books_to_scrape):
         try:
             isbn, book_id = bid
-            print(str(datetime.now()) + ' ' + script_name + ': Scraping isbn:' + str(isbn) + ' book_id:' + str(book_id) + '...')
-            print(str(datetime.now()) + ' ' + script_name + ': #' + str(i+1+len(books_already_scraped)) + ' out of ' + str(len(book_ids)) + ' books')
-
-            book = scrape_book(isbn, book_id)
+            print(str(datetime.now()) + ' ' + script_name + ': Fetching isbn:' + str(isbn) + ' book_id:' + str(book_id) + '...')
+            print(str(datetime.now()) + ' ' + script_name + ': #' + str(i+1+len(books_already_scraped | pages_fetched)) + ' out of ' + str(len(book_ids)) + ' books')
 
-            if book != '':
-                if book['isbn']=='isbn not found':
-                    print('isbn not found')
-            
-            # Add book metadata to file name to be more specific
-            filename = args.output_directory_path + '/' + str(isbn) + '-' + str(book_id) + '_book-metadata.json'
-            json.dump(book, open(filename,'w'))
+            html, final_url = fetch_page(book_url(isbn, book_id))
 
-            print('=============================')
+            # Committed as soon as it is fetched, so a rerun resumes after it
+            store.add_page(str(isbn) + '-' + str(book_id), html, final_url)
 
         except HTTPError as e:
             print(e)
             exit(0)
 
-
-    books = condense_books(args.output_directory_path)
-    if args.format == 'json':
-        json.dump(books, open(f"{condensed_books_path}.json", 'w'))
-    elif args.format == 'csv':
-        json.dump(books, open(f"{condensed_books_path}.json", 'w'))
-        book_df = pd.read_json(f"{condensed_books_path}.json")
-        book_df.to_csv(f"{condensed_books_path}.csv", index=False, encoding='utf-8')
+    # Parse the pages not parsed yet in parallel
+    pages_fetched = store.page_keys()
+    keys_to_parse = sorted(pages_fetched if args.reparse == 'Yes' else pages_fetched - store.keys())
+    print(str(datetime.now()) + ' ' + script_name + ': parsing ' + str(len(keys_to_parse)) + ' pages with ' + html_parser)
+    parsed, errors = parse_pages(store, keys_to_parse, args.parse_workers)
+    print(str(datetime.now()) + ' ' + script_name + ': ' + str(parsed) + ' pages parsed, ' + str(len(errors)) + ' failed')
+
+    store.export_json(f"{condensed_books_path}.json")
+    if args.format == 'csv':
+        store.export_csv(f"{condensed_books_path}.csv")
+    store.close()
         
     print(str(datetime.now()) + ' ' + script_name + f':\n\n🎉 Success! All book metadata scraped. 🎉\n\nMetadata files have been output to /{args.output_directory_path}\nGoodreads scraping run time = ⏰ ' + str(datetime.now() - start_time) + ' ⏰')
 
@@ -1,18 +1,15 @@
 import argparse
 from datetime import datetime
 import json
+import google_books
 import os
 import re
-import requests
-import time
+import scrape_store
 
 from urllib.request import urlopen
 from urllib.error import HTTPError
 import bs4
 import pandas as pd
-def get_id(json):
-    return json['items'][0]['id']
-
 def get_volume_info(volume_info, key):
     if key in volume_info.keys():
         return volume_info[key]
@@ -27,52 +24,35 @@ def get_thumbnail(imageLinks, type):
     else:
         return None
 
+def book_metadata(isbn, volume):
+    ''' Book metadata from a Google Books volume.
+        Args: isbn, volume (first search result from google_books.get_volume, None if not found)
+        Returns: dictionary, or '' if Google Books has no volume info for the ISBN
+    '''
+    if not volume or 'volumeInfo' not in volume.keys():
+        return ''
+    volume_info = volume['volumeInfo']
+    return {'goog_id':              volume['id'],
+            'book_title':           get_volume_info(volume_info,'title'),
+            'book_link':            get_volume_info(volume_info, 'infoLink'),
+            'isbn':                 isbn,
+            'year_first_published': get_volume_info(volume_info,'publishedDate'),
+            'publisher':            get_volume_info(volume_info,'publisher'),
+            'author':               get_volume_info(volume_info,'authors'),
+            'num_pages':            get_volume_info(volume_info,'pageCount'),
+            'description':          get_volume_info(volume_info,'description'),
+            'genres':               get_volume_info(volume_info,'categories'),
+            'num_ratings':          get_volume_info(volume_info,'ratingsCount'),
+            'average_rating':       get_volume_info(volume_info,'averageRating'),
+            'image-S':              get_thumbnail(get_volume_info(volume_info,'imageLinks'),'smallThumbnail'),
+            'image':                get_thumbnail(get_volume_info(volume_info,'imageLinks'),'thumbnail'),
+            'language':             get_volume_info(volume_info,'language')}
+
 def scrape_book(isbn):
     if isbn: # BX dataset only has ISBN. Most of the GR dataset also, but some... do not.
-        url = 'https://www.googleapis.com/books/v1/volumes'
+        return book_metadata(isbn, google_books.get_volume(isbn))
     else:
         return ''
-        
-    response = requests.get(url, params={"q": 'isbn:'+isbn})
-    json = response.json()
-    time.sleep(3)
-
-    try: 
-        if json['totalItems']!=0 and 'volumeInfo' in json['items'][0].keys():
-            volume_info = json['items'][0]['volumeInfo']
-            return {'goog_id':              get_id(json),
-                    'book_title':           get_volume_info(volume_info,'title'),
-                    'book_link':            get_volume_info(volume_info, 'infoLink'),
-                    'isbn':                 isbn,
-                    'year_first_published': get_volume_info(volume_info,'publishedDate'),
-                    'publisher':            get_volume_info(volume_info,'publisher'),
-                    'author':               get_volume_info(volume_info,'authors'),
-                    'num_pages':            get_volume_info(volume_info,'pageCount'),
-                    'description':          get_volume_info(volume_info,'description'),
-                    'genres':               get_volume_info(volume_info,'categories'),
-                    'num_ratings':          get_volume_info(volume_info,'ratingsCount'),
-                    'average_rating':       get_volume_info(volume_info,'averageRating'),
-                    'image-S':              get_thumbnail(get_volume_info(volume_info,'imageLinks'),'smallThumbnail'),
-                    'image':                get_thumbnail(get_volume_info(volume_info,'imageLinks'),'thumbnail'),
-                    'language':             get_volume_info(volume_info,'language')}
-        else:
-            return ''
-
-    except KeyError as e:
-        print(e, isbn)
-        exit(0)    
-
-def condense_books(books_directory_path):
-
-    books = []
-    
-    # Look for all the files in the directory and if they contain "book-metadata," then load them all and condense them into a single file
-    for file_name in os.listdir(books_directory_path):
-        if file_name.endswith('.json') and not file_name.startswith('.') and file_name != "all_books.json" and "book-metadata" in file_name:
-            _book = json.load(open(books_directory_path + '/' + file_name, 'r')) #, encoding='utf-8', errors='ignore'))
-            books.append(_book)
-
-    return books
 
 def main():
 
@@ -90,36 +70,32 @@ def main():
     df_books = pd.read_csv(args.filename, encoding='unicode-escape')
 
     book_ids              = df_books['isbn'].apply(lambda x: x.strip().upper().zfill(10)).values
-    books_already_scraped =  [file_name.replace('_book-metadata.json', '').split('-')[0].upper() for file_name in os.listdir(args.output_directory_path) if file_name.endswith('.json') and not file_name.startswith('all_books')]
-    books_to_scrape       = [isbn.upper() for isbn in book_ids if isbn.upper() not in books_already_scraped]
+    # Store keyed by ISBN (the file names of earlier runs were ISBN-_book-metadata.json)
+    store                 = scrape_store.open_store(args.output_directory_path, lambda stem: stem.split('-')[0].upper())
+    books_already_scraped = store.keys()
+    books_to_scrape       = list(dict.fromkeys(isbn.upper() for isbn in book_ids if isbn and isbn.upper() not in books_already_scraped))
     condensed_books_path   = args.output_directory_path + '/all_books'
 
-    for i, isbn in enumerate(books_to_scrape):
-        try:
-            print(str(datetime.now()) + ' ' + script_name + ': getting isbn:' + str(isbn) + '...')
-            print(str(datetime.now()) + ' ' + script_name + ': #' + str(i+1+len(books_already_scraped)) + ' out of ' + str(len(book_ids)) + ' books')
-
-            book = scrape_book(isbn)
-            
-            # Add book metadata to file name to be more specific
-            filename = args.output_directory_path + '/' + str(isbn).upper() + '-' + '_book-metadata.json'
-            json.dump(book, open(filename,'w'))
-
-            print('=============================')
-
-        except HTTPError as e:
-            print(e)
-            exit(0)
-
+    def save_batch(books, errors):
+        # Checkpoint: each batch is committed to the store, so a rerun skips it. Failed ISBNs are not stored and are retried.
+        store.add_many(books)
+        for isbn, error in errors.items():
+            print(str(datetime.now()) + ' ' + script_name + ': isbn ' + str(isbn) + ' failed: ' + error)
+        print(str(datetime.now()) + ' ' + script_name + ': ' + str(len(books)) + ' books saved')
+        print('=============================')
+
+    print(str(datetime.now()) + ' ' + script_name + ': ' + str(len(books_already_scraped)) + ' out of ' + str(len(book_ids)) + ' books already scraped')
+    books, errors = google_books.fetch_all(books_to_scrape, book_metadata, save_batch)
+    if errors:
+        # ISBNs that still failed after the retries, for a later run
+        pd.DataFrame({'isbn': list(errors.keys()), 'error': list(errors.values())}).to_csv(
+            args.output_directory_path + '/errors.csv', index=False)
+
+    store.export_json(f"{condensed_books_path}.json")
+    if args.format == 'csv':
+        store.export_csv(f"{condensed_books_path}.csv")
+    store.close()
 
-    books = condense_books(args.output_directory_path)
-    if args.format == 'json':
-        json.dump(books, open(f"{condensed_books_path}.json", 'w'))
-    elif args.format == 'csv':
-        json.dump(books, open(f"{condensed_books_path}.json", 'w'))
-        book_df = pd.read_json(f"{condensed_books_path}.json")
-        book_df.to_csv(f"{condensed_books_path}.csv", index=False, encoding='utf-8')
-        
     print(str(datetime.now()) + ' ' + script_name + f':\n\n🎉 Success! All book metadata scraped. 🎉\n\nMetadata files have been output to /{args.output_directory_path}\nGoodreads scraping run time = ⏰ ' + str(datetime.now() - start_time) + ' ⏰')
 
 
@@ -0,0 +1,115 @@
+import argparse
+import os
+import tempfile
+import time
+
+import bs4
+import numpy as np
+
+import get_books
+import scrape_store
+
+# Benchmark of the Goodreads page parsing on generated book pages (the layout get_books parses): the old
+# single pass (html.parser, str(soup) for each regular expression) against get_books.parse_book, in one process
+# and with the process pool, checking both give the same books.
+
+def legacy_parse(html, final_url):
+    ''' scrape_book's parsing as it was before get_books.parse_book '''
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    if soup.find('h1', {'id': 'bookTitle'}):
+        return {'goodreads_book_id':    get_books.get_id(final_url),
+                'book_title':           ' '.join(soup.find('h1', {'id': 'bookTitle'}).text.split()),
+                "book_series":          get_books.get_series_name(soup),
+                "book_series_uri":      get_books.get_series_uri(soup),
+                'top_5_other_editions': get_books.get_top_5_other_editions(soup),
+                'isbn':                 get_books.get_isbn(soup),
+                'isbn13':               get_books.get_isbn13(soup),
+                'year_first_published': get_books.get_year_first_published(soup),
+                'authorlink':           soup.find('a', {'class': 'authorName'})['href'],
+                'author':               ' '.join(soup.find('span', {'itemprop': 'name'}).text.split()),
+                'num_pages':            get_books.get_num_pages(soup),
+                'description':          get_books.get_description(soup),
+                'genres':               get_books.get_genres(soup),
+                'num_ratings':          soup.find('meta', {'itemprop': 'ratingCount'})['content'].strip(),
+                'num_reviews':          soup.find('meta', {'itemprop': 'reviewCount'})['content'].strip(),
+                'average_rating':       soup.find('span', {'itemprop': 'ratingValue'}).text.strip(),
+                'rating_distribution':  get_books.get_rating_distribution(soup)}
+    return ''
+
+def fixture_page(i, rng, reviews=40):
+    ''' A book page with the elements get_books reads, surrounded by reviews and scripts like the real pages.
+        Every tenth page is a search page with no results.
+        Returns: html (bytes), final url
+    '''
+    if i % 10 == 9:
+        return (f'<html><body><h1>Search results</h1><p>No results for {i}</p></body></html>'.encode(),
+                f'https://www.goodreads.com/search/?q={i:010d}')
+    words = ['book', 'café', 'story', 'l\'amour', 'war', '&amp;', 'peace', 'dragon', 'naïve', 'night']
+    text = lambda n: ' '.join(rng.choice(words, n))
+    series = f'<a href="/series/{i}-saga">(Saga #{i % 7 + 1})</a>' if i % 3 else ''
+    distribution = ', '.join(str(n) for n in rng.integers(0, 5000, 5))
+    genres = ''.join(f'<div class="elementList"><div class="left"><a class="actionLinkLite bookPageGenreLink" href="/genres/g{g}">'
+                     f'Genre {g}</a> &rsaquo; <a class="actionLinkLite bookPageGenreLink" href="/genres/s{g}">Sub {g}</a></div></div>'
+                     for g in rng.integers(0, 50, 4))
+    editions = ''.join(f'<div class="otherEdition"><a href="/book/show/{i * 10 + e}"><img src="e.jpg"></a></div>' for e in range(5))
+    review_divs = ''.join(f'<div class="review"><a class="user" href="/user/show/{r}">Reader {r}</a>'
+                          f'<span class="readable">{text(60)}</span></div>' for r in range(reviews))
+    html = f'''<!DOCTYPE html><html><head><title>Book {i}</title>
+<script type="text/javascript">var newTip = new Tip($('x'), "<div>Book {i}\\nisbn: {i:010d}\\nisbn13: {978 * 10**10 + i:013d}\\n</div>");</script>
+</head><body><div class="header">{text(30)}</div>
+<div id="metacol"><h1 id="bookTitle" class="gr-h1"> Book {i} {text(3)}
+</h1><h2 id="bookSeries">{series}</h2>
+<a class="authorName" href="/author/show/{i % 997}.Author"><span itemprop="name">Author  {i % 997}</span></a>
+<span itemprop="ratingValue"> {rng.uniform(1, 5):.2f} </span>
+<meta itemprop="ratingCount" content=" {rng.integers(0, 10**6)} "><meta itemprop="reviewCount" content="{rng.integers(0, 10**4)}">
+<div id="description"><span id="freeTextContainer">{text(20)}</span><span id="freeText" style="display:none">{text(120)}</span></div>
+<div id="details"><span itemprop="numberOfPages">{rng.integers(50, 900)} pages</span>
+<nobr class="greyText">(first published {rng.integers(1800, 2020)})</nobr></div></div>
+{genres}{editions}{review_divs}
+<script type="text/javascript">renderRatingGraph([{distribution}]);</script>
+</body></html>'''
+    return html.encode('utf-8'), f'https://www.goodreads.com/book/show/{i}.Book_{i}'
+
+def pages_per_second(parse, pages):
+    time1 = time.perf_counter()
+    books = [parse(html, final_url) for html, final_url in pages]
+    return books, len(pages) / (time.perf_counter() - time1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=300, help='generated pages')
+    parser.add_argument('--reviews', type=int, default=150, help='reviews per page, sets the page size')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='processes for the pool run')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pages = [fixture_page(i, rng, args.reviews) for i in range(args.pages)]
+    print(f'{len(pages)} pages, {sum(len(html) for html, url in pages) / len(pages) / 1024:.0f} KB on average, parser {get_books.html_parser}')
+
+    legacy_books, legacy_rate = pages_per_second(legacy_parse, pages)
+    books, rate = pages_per_second(get_books.parse_book, pages)
+    html_parser_books, html_parser_rate = pages_per_second(lambda html, url: get_books.parse_book(html, url, 'html.parser'), pages)
+    differences = sum(book != legacy for book, legacy in zip(books, legacy_books))
+    differences += sum(book != legacy for book, legacy in zip(html_parser_books, legacy_books))
+    print(f'legacy: {legacy_rate:.0f} pages/s, parse_book with html.parser: {html_parser_rate:.0f} pages/s, '
+          f'parse_book with {get_books.html_parser}: {rate:.0f} pages/s (one core)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = scrape_store.ScrapeStore(os.path.join(directory, 'books.sqlite'))
+        keys = [str(i) for i in range(len(pages))]
+        for key, (html, final_url) in zip(keys, pages):
+            store.add_page(key, html, final_url)
+        time1 = time.perf_counter()
+        parsed, errors = get_books.parse_pages(store, keys, args.workers)
+        pool_rate = parsed / (time.perf_counter() - time1)
+        stored = dict(zip(keys, store.books()))
+        differences += sum(stored[key] != legacy for key, legacy in zip(keys, legacy_books))
+        store.close()
+    print(f'process pool: {pool_rate:.0f} pages/s with {args.workers} workers ({pool_rate / args.workers:.0f} pages/s per core), '
+          f'{len(errors)} errors')
+    print(differences, 'differences from the legacy parse')
+    if differences or errors:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
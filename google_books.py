@@ -0,0 +1,149 @@
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_cache
+
+# Volumes endpoint, overridable to point the fetcher at a local stub server
+volumes_url = os.environ.get('blf_google_books_url', 'https://www.googleapis.com/books/v1/volumes')
+# Optional API key, raises the daily quota
+api_key = os.environ.get('blf_google_books_key')
+# Requests per second shared by all the threads, and how many can go out back to back
+rate = float(os.environ.get('blf_google_books_rate', 1))
+burst = int(os.environ.get('blf_google_books_burst', 4))
+workers = int(os.environ.get('blf_google_books_workers', 4))
+# Retries of timeouts, connection errors, truncated responses, 429 and 5xx, waiting backoff * 2**attempt seconds (plus jitter)
+retries = int(os.environ.get('blf_google_books_retries', 5))
+backoff = float(os.environ.get('blf_google_books_backoff', 1))
+timeout = float(os.environ.get('blf_google_books_timeout', 10))
+# ISBNs per batch: the batch callback (checkpoint) runs after each one
+batch_size = int(os.environ.get('blf_google_books_batch', 100))
+
+class TokenBucket:
+    ''' Rate limiter shared by threads: tokens refill at rate per second up to capacity,
+        and acquire blocks until one is available.'''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class FetchError(Exception):
+    '''A request that failed for good (after the retries, or with a status not worth retrying).'''
+
+bucket = TokenBucket(rate, burst)
+_local = threading.local()
+
+def session():
+    '''One requests.Session per thread, so each thread reuses its connections.'''
+    if getattr(_local, 'session', None) is None:
+        _local.session = requests.Session()
+        _local.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        _local.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+    return _local.session
+
+def retry_wait(attempt, response=None):
+    '''Seconds to wait before retry number attempt: Retry-After if the server sent one, else exponential backoff.'''
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return float(response.headers['Retry-After'])
+    return backoff * 2 ** attempt * (1 + random.random() / 2)
+
+def get_json(url, params, limiter=None):
+    ''' GET a JSON document from the HTTP cache, or through the rate limiter retrying transient failures.
+        Args: url, params (dictionary of query parameters), limiter (TokenBucket, defaults to the shared one)
+        Returns: the decoded JSON
+        Raises: FetchError
+    '''
+    cache = http_cache.get_cache()
+    cached = cache.get(url, params) if cache else None
+    if cached:
+        return json.loads(cached[0])
+
+    limiter = limiter or bucket
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            response = session().get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error, response = f'{type(e).__name__}: {e}', None
+        except requests.RequestException as e:
+            # Invalid URL, too many redirects...: retrying would fail the same way
+            raise FetchError(f'{type(e).__name__}: {e}')
+        else:
+            if response.status_code == 200:
+                try:
+                    result = response.json()
+                except ValueError:
+                    raise FetchError(f'invalid JSON from {url}')
+                if cache:
+                    cache.set(url, params, response.content)
+                return result
+            error = f'HTTP {response.status_code}'
+            if response.status_code != 429 and response.status_code < 500:
+                raise FetchError(error)
+        if attempt < retries:
+            time.sleep(retry_wait(attempt, response))
+    raise FetchError(f'{error} after {retries + 1} attempts')
+
+def get_volume(isbn, limiter=None):
+    ''' Google Books search result for an ISBN.
+        Returns: the first volume (dictionary), or None if Google Books does not have the ISBN
+        Raises: FetchError
+    '''
+    params = {'q': 'isbn:' + isbn}
+    if api_key:
+        params['key'] = api_key
+    result = get_json(volumes_url, params, limiter)
+    if not result.get('totalItems') or not result.get('items'):
+        return None
+    return result['items'][0]
+
+def fetch_all(isbns, parse=None, on_batch=None, n_workers=None, limiter=None):
+    ''' Fetch many ISBNs concurrently. A failed ISBN is recorded with its error instead of stopping the run.
+        Args: isbns (list of ISBNs), parse (function of (isbn, volume) applied to each result, volume may be None),
+              on_batch (function of (results, errors) called after each batch of batch_size ISBNs,
+              e.g. to write them to disk so an interrupted run can resume),
+              n_workers (threads, defaults to blf_google_books_workers)
+        Returns: results (dictionary of isbn: parsed volume), errors (dictionary of isbn: error message)
+    '''
+    parse = parse or (lambda isbn, volume: volume)
+
+    def fetch(isbn):
+        return parse(isbn, get_volume(isbn, limiter))
+
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=n_workers or workers) as pool:
+        for start in range(0, len(isbns), batch_size):
+            batch = isbns[start:start + batch_size]
+            batch_results, batch_errors = {}, {}
+            for isbn, future in zip(batch, [pool.submit(fetch, isbn) for isbn in batch]):
+                try:
+                    batch_results[isbn] = future.result()
+                except Exception as e:
+                    # Whatever fetch or parse raised, only this ISBN fails
+                    batch_errors[isbn] = f'{type(e).__name__}: {e}'
+            results.update(batch_results)
+            errors.update(batch_errors)
+            if on_batch:
+                on_batch(batch_results, batch_errors)
+            print(f'{min(start + batch_size, len(isbns))} of {len(isbns)} ISBNs fetched, {len(errors)} errors')
+    return results, errors
@@ -0,0 +1,132 @@
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import google_books
+import http_cache
+
+# Check of the google_books fetcher against a local stub of the volumes endpoint. The ISBN's first digit picks
+# how the stub answers: 0 not found, 4 HTTP 404, 5 two HTTP 503 then found, 6 HTTP 429 then found,
+# 7 invalid JSON, 8 a truncated body then found, anything else found. A second run must be served from the HTTP
+# cache except for the failures.
+
+class StubHandler(BaseHTTPRequestHandler):
+    attempts = Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        isbn = parse_qs(urlparse(self.path).query)['q'][0].split(':')[1]
+        with self.lock:
+            self.attempts[isbn] += 1
+            attempt = self.attempts[isbn]
+        if isbn[0] == '4' or (isbn[0] == '5' and attempt <= 2) or (isbn[0] == '6' and attempt == 1):
+            status = {'4': 404, '5': 503, '6': 429}[isbn[0]]
+            self.send_response(status)
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+        if isbn[0] == '8' and attempt == 1:
+            # Content-Length longer than the body, then the connection closes
+            self.send_response(200)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            self.wfile.write(b'{"totalItems": 1')
+            self.close_connection = True
+            return
+        if isbn[0] == '7':
+            body = b'not json'
+        elif isbn[0] == '0':
+            body = json.dumps({'totalItems': 0}).encode()
+        else:
+            body = json.dumps({'totalItems': 1, 'items': [{'id': 'g' + isbn, 'volumeInfo': {
+                'title': 'Book ' + isbn, 'authors': ['Author ' + isbn]}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--isbns', type=int, default=200, help='ISBNs to fetch from the stub')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second')
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    google_books.volumes_url = f'http://127.0.0.1:{server.server_port}/books/v1/volumes'
+    google_books.backoff = 0.01
+    google_books.batch_size = 50
+
+    cache_dir = tempfile.TemporaryDirectory()
+    http_cache.cache_path = os.path.join(cache_dir.name, 'http_cache.sqlite')
+
+    isbns = ['%d%09d' % (i % 10, i) for i in range(args.isbns)]
+    batches = []
+    time1 = time.perf_counter()
+    results, errors = google_books.fetch_all(isbns, on_batch=lambda results, errors: batches.append(len(results) + len(errors)),
+                                             n_workers=args.workers, limiter=google_books.TokenBucket(args.rate, args.workers))
+    seconds = time.perf_counter() - time1
+    requests_made = sum(StubHandler.attempts.values())
+
+    time1 = time.perf_counter()
+    cached_results, cached_errors = google_books.fetch_all(isbns, n_workers=args.workers,
+                                                           limiter=google_books.TokenBucket(args.rate, args.workers))
+    cached_seconds = time.perf_counter() - time1
+    rerun_requests = sum(StubHandler.attempts.values()) - requests_made
+
+    # An exception from parse fails only its ISBN, an invalid URL fails without retries
+    def parse(isbn, volume):
+        if isbn[-1] == '3':
+            raise RuntimeError('parse failed')
+        return volume
+    parsed, parse_errors = google_books.fetch_all(isbns[:50], parse, n_workers=args.workers)
+    try:
+        google_books.get_json('http://', {})
+        invalid_url = 'no error'
+    except google_books.FetchError as e:
+        invalid_url = str(e)
+    server.shutdown()
+
+    print(f'{len(isbns)} ISBNs, {requests_made} requests in {seconds:.2f} s ({requests_made / seconds:.0f} requests/s, limit {args.rate:.0f})')
+    print(len(results), 'fetched,', sum(volume is None for volume in results.values()), 'not found,', len(errors), 'errors,', len(batches), 'batches')
+    print(f'rerun: {rerun_requests} requests in {cached_seconds:.2f} s, cache {http_cache.get_cache().stats()}')
+    expected_errors = {isbn for isbn in isbns if isbn[0] in '47'}
+    problems = []
+    if set(errors) != expected_errors:
+        problems.append('errors for ' + str(sorted(set(errors) ^ expected_errors)[:5]))
+    if any(results[isbn] is not None for isbn in results if isbn[0] == '0'):
+        problems.append('not found ISBNs returned a volume')
+    if any(results[isbn] is None or results[isbn]['id'] != 'g' + isbn for isbn in results if isbn[0] != '0'):
+        problems.append('wrong volumes')
+    if sum(batches) != len(isbns):
+        problems.append('batches do not cover the ISBNs')
+    if requests_made / seconds > args.rate * 1.1 + args.workers / seconds:
+        problems.append('rate limit exceeded')
+    if cached_results != results or set(cached_errors) != expected_errors:
+        problems.append('rerun from the cache differs')
+    # Only the failed ISBNs go back to the server: 404 once, invalid JSON once
+    if rerun_requests != len(expected_errors):
+        problems.append(f'rerun made {rerun_requests} requests')
+    if set(parse_errors) != {isbn for isbn in isbns[:50] if isbn[-1] == '3' or isbn[0] in '47'} or len(parsed) + len(parse_errors) != 50:
+        problems.append('parse errors not recorded per ISBN')
+    if not invalid_url.startswith('InvalidURL'):
+        problems.append('invalid URL: ' + invalid_url)
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Single file cache of HTTP responses shared by the scrapers, so reruns do not refetch books already seen.
+# An empty blf_http_cache disables it.
+cache_path = os.environ.get('blf_http_cache', 'http_cache.sqlite')
+cache_ttl = float(os.environ.get('blf_http_cache_ttl', 30 * 24 * 3600))
+cache_max_mb = float(os.environ.get('blf_http_cache_max_mb', 1024))
+
+# Query parameters that do not change the response (credentials), left out of the key
+ignored_params = {'key'}
+
+def normalize(url, params=None):
+    ''' Canonical form of a request: lower case scheme and host, query parameters (including params) sorted,
+        credentials dropped. Two requests for the same resource give the same string.
+        Args: url, params (dictionary of query parameters, optional)
+        Returns: string
+    '''
+    parts = urlsplit(url)
+    query = parse_qsl(parts.query, keep_blank_values=True) + list((params or {}).items())
+    query = sorted((key, str(value)) for key, value in query if key not in ignored_params)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urlencode(query), ''))
+
+class HTTPCache:
+    ''' Responses stored in SQLite under the SHA-256 of the normalized request, zlib compressed.
+        Entries older than ttl seconds are treated as missing, and past max_bytes the least recently used
+        entries are evicted. Safe to share between threads (one connection per thread) and processes.'''
+    def __init__(self, path, ttl=cache_ttl, max_bytes=cache_max_mb * 2**20):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, final_url TEXT,
+                        body BLOB, size INTEGER, stored REAL, accessed REAL)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        conn.commit()
+        self._size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _conn(self):
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn.execute('PRAGMA journal_mode=WAL')
+        return self._local.conn
+
+    @staticmethod
+    def key(url, params=None):
+        return hashlib.sha256(normalize(url, params).encode()).hexdigest()
+
+    def get(self, url, params=None):
+        ''' Returns: (body bytes, final url after redirects) or None if not cached or expired.'''
+        conn = self._conn()
+        key = self.key(url, params)
+        row = conn.execute('SELECT body, final_url, stored FROM responses WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[2] > self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+        conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        conn.commit()
+        with self._lock:
+            self.hits += 1
+        return zlib.decompress(row[0]), row[1]
+
+    def set(self, url, params, body, final_url=None):
+        ''' Store a response body (bytes).
+            Args: url, params (as passed to get), body, final_url (url after redirects, defaults to url)
+        '''
+        conn = self._conn()
+        data = zlib.compress(body)
+        now = time.time()
+        key = self.key(url, params)
+        # A response stored again replaces the old one, whose size no longer counts
+        old = conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (key, normalize(url, params), final_url or url, data, len(data), now, now))
+        conn.commit()
+        with self._lock:
+            self._size += len(data) - (old[0] if old else 0)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        '''Delete expired entries, then least recently used ones until the cache is under max_bytes.'''
+        conn = self._conn()
+        expired = conn.execute('DELETE FROM responses WHERE stored < ?', (time.time() - self.ttl,)).rowcount
+        size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        removed = 0
+        # Oldest entries a batch at a time
+        while size > self.max_bytes:
+            batch = conn.execute('SELECT key, size FROM responses ORDER BY accessed LIMIT 100').fetchall()
+            if not batch:
+                break
+            for key, entry_size in batch:
+                if size <= self.max_bytes:
+                    break
+                conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                size -= entry_size
+                removed += 1
+        conn.commit()
+        with self._lock:
+            self._size = size
+            self.evictions += expired + removed
+
+    def stats(self):
+        count = self._conn().execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'entries': count, 'bytes': self._size, 'max_bytes': self.max_bytes, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    '''The shared cache at blf_http_cache, opened on first use. None when caching is disabled.'''
+    global _cache
+    if not cache_path:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = HTTPCache(cache_path)
+        return _cache
@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+from joblib import Parallel, delayed
+from scipy import sparse
+
+# Ratings at or above this count as "liked" (ratings are on the 0-5 scale)
+min_rating = 4.0
+top_n = 20
+block_size = 2048
+n_jobs = int(os.environ.get('blf_n_jobs', -1))
+
+def liked_matrix(features, threshold=min_rating):
+    '''Binary users x books matrix of the ratings >= threshold.'''
+    features = sparse.csr_matrix(features)
+    liked = sparse.csr_matrix(((features.data >= threshold).astype(np.float32), features.indices.copy(),
+                               features.indptr.copy()), shape=features.shape)
+    liked.eliminate_zeros()
+    return liked
+
+def _top_block(liked_t, liked, counts, cols, n):
+    ''' Cosine similarity of the liked columns cols against every book, keeping the n best per book.
+        Returns: list of (neighbors, scores) arrays, one per column
+    '''
+    co = liked_t[cols].dot(liked).tocsr()
+    rows = []
+    for i, col in enumerate(cols):
+        start, end = co.indptr[i], co.indptr[i + 1]
+        neighbors, co_counts = co.indices[start:end], co.data[start:end]
+        keep = neighbors != col
+        neighbors, co_counts = neighbors[keep], co_counts[keep]
+        scores = co_counts / np.sqrt(counts[col] * counts[neighbors])
+        if len(scores) > n:
+            # Keep every book tied with the n-th score, so ties go to the lowest column whatever the partition
+            top = np.argpartition(-scores, n - 1)[:n]
+            top = np.flatnonzero(scores >= scores[top].min())
+            neighbors, scores = neighbors[top], scores[top]
+        order = np.lexsort((neighbors, -scores))[:n]
+        rows.append((neighbors[order].astype(np.int32), scores[order].astype(np.float32)))
+    return rows
+
+def _block_rows(liked, cols, n=top_n, size=block_size, jobs=n_jobs):
+    # Work through the columns in blocks so only block_size rows of the co-rating product exist at once
+    liked_t = liked.T.tocsr()
+    counts = np.asarray(liked.sum(axis=0)).ravel()
+    blocks = [cols[start:start + size] for start in range(0, len(cols), size)]
+    results = Parallel(n_jobs=jobs)(delayed(_top_block)(liked_t, liked, counts, block, n) for block in blocks)
+    return [row for block in results for row in block]
+
+class ItemSimilarity:
+    ''' Top-N "readers who liked X also liked" books for every book, stored as flat arrays
+        (CSR layout: the neighbors of the book in column c are neighbors[indptr[c]:indptr[c+1]]).
+        Lookups by blf_book_id go through a dense position array, so they are O(1).'''
+    def __init__(self, book_ids, indptr, neighbors, scores):
+        self.book_ids = np.asarray(book_ids, dtype=np.int64)
+        self.indptr = indptr
+        self.neighbors = neighbors
+        self.scores = scores
+        self._position = np.full(self.book_ids.max() + 1 if len(self.book_ids) else 1, -1, dtype=np.int32)
+        self._position[self.book_ids] = np.arange(len(self.book_ids), dtype=np.int32)
+
+    @classmethod
+    def from_rows(cls, book_ids, rows):
+        lengths = np.array([len(neighbors) for neighbors, scores in rows], dtype=np.int64)
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        neighbors = np.concatenate([neighbors for neighbors, scores in rows] or [np.empty(0, np.int32)])
+        scores = np.concatenate([scores for neighbors, scores in rows] or [np.empty(0, np.float32)])
+        return cls(book_ids, indptr, neighbors, scores)
+
+    def rows(self):
+        return [(self.neighbors[self.indptr[c]:self.indptr[c + 1]], self.scores[self.indptr[c]:self.indptr[c + 1]])
+                for c in range(len(self.book_ids))]
+
+    def similar(self, blf_book_id, k=5):
+        ''' Args: blf_book_id (int), k (number of books)
+            Returns: list of blf_book_ids most often liked by the readers who liked blf_book_id
+        '''
+        if blf_book_id >= len(self._position) or self._position[blf_book_id] < 0:
+            return []
+        c = self._position[blf_book_id]
+        return self.book_ids[self.neighbors[self.indptr[c]:self.indptr[c + 1]][:k]].tolist()
+
+def build(features, book_ids, n=top_n, threshold=min_rating, size=block_size, jobs=n_jobs):
+    ''' Compute the item to item table from the users x books ratings matrix.
+        Args: features (sparse ratings matrix, columns in book_ids order), book_ids (blf_book_id of each column),
+              n (neighbors kept per book), threshold (minimum rating that counts as liked),
+              size (books per block), jobs (parallel processes, -1 for all cores)
+        Returns: ItemSimilarity
+    '''
+    liked = liked_matrix(features, threshold)
+    rows = _block_rows(liked, np.arange(liked.shape[1]), n, size, jobs)
+    return ItemSimilarity.from_rows(book_ids, rows)
+
+def update(table, features, book_ids, changed_book_ids, n=top_n, threshold=min_rating, size=block_size, jobs=n_jobs):
+    ''' Recompute the rows of the books that received new ratings, and patch their new scores into the rows
+        of the books they share readers with, instead of rebuilding the whole table.
+        Args: table (ItemSimilarity from the previous build), features/book_ids (updated ratings matrix),
+              changed_book_ids (blf_book_ids with new ratings)
+        Returns: ItemSimilarity
+    '''
+    book_ids = np.asarray(book_ids)
+    liked = liked_matrix(features, threshold)
+
+    # Carry the old rows over to the (possibly larger) new column order
+    position = np.full(max(book_ids.max(), table.book_ids.max()) + 1, -1, dtype=np.int32)
+    position[book_ids] = np.arange(len(book_ids), dtype=np.int32)
+    old_rows = dict(zip(table.book_ids.tolist(), table.rows()))
+    empty = (np.empty(0, np.int32), np.empty(0, np.float32))
+    rows = []
+    for book_id in book_ids.tolist():
+        neighbors, scores = old_rows.get(book_id, empty)
+        neighbors = position[table.book_ids[neighbors]]
+        rows.append((neighbors[neighbors >= 0], scores[neighbors >= 0]))
+
+    changed = np.flatnonzero(np.isin(book_ids, changed_book_ids))
+    is_changed = np.zeros(len(book_ids), dtype=bool)
+    is_changed[changed] = True
+
+    # Every similarity involving a changed book may have moved, so take their full rows (not cut to n)
+    full_rows = _block_rows(liked, changed, len(book_ids), size, jobs)
+    patch_rows, patch_cols, patch_scores = [], [], []
+    for col, (neighbors, scores) in zip(changed, full_rows):
+        rows[col] = (neighbors[:n], scores[:n])
+        patch_rows.append(neighbors)
+        patch_cols.append(np.full(len(neighbors), col, dtype=np.int32))
+        patch_scores.append(scores)
+    patch_rows = np.concatenate(patch_rows or [np.empty(0, np.int32)])
+    patch_cols = np.concatenate(patch_cols or [np.empty(0, np.int32)])
+    patch_scores = np.concatenate(patch_scores or [np.empty(0, np.float32)])
+    keep = ~is_changed[patch_rows]
+    patch_rows, patch_cols, patch_scores = patch_rows[keep], patch_cols[keep], patch_scores[keep]
+    order = np.argsort(patch_rows, kind='stable')
+    patch_rows, patch_cols, patch_scores = patch_rows[order], patch_cols[order], patch_scores[order]
+    patched, starts = np.unique(patch_rows, return_index=True)
+    ends = np.append(starts[1:], len(patch_rows))
+    patches = {row: (start, end) for row, start, end in zip(patched.tolist(), starts, ends)}
+
+    # Patch the other books' rows: the scores with changed books are replaced by the new ones
+    affected = set(patches) | {c for c, (neighbors, scores) in enumerate(rows)
+                               if not is_changed[c] and is_changed[neighbors].any()}
+    recompute = []
+    for c in sorted(affected):
+        neighbors, scores = rows[c]
+        keep = ~is_changed[neighbors]
+        start, end = patches.get(c, (0, 0))
+        new_neighbors = np.concatenate((neighbors[keep], patch_cols[start:end]))
+        new_scores = np.concatenate((scores[keep], patch_scores[start:end]))
+        order = np.lexsort((new_neighbors, -new_scores))[:n]
+        # The old row was cut at n: books it left out score at most its last score, so if a changed book
+        # dropped out and the patched row reaches down to that score, the row has to be computed again
+        if len(neighbors) >= n and not keep.all() and (len(order) < n or new_scores[order[-1]] <= scores[-1]):
+            recompute.append(c)
+        rows[c] = (new_neighbors[order], new_scores[order])
+
+    for col, row in zip(recompute, _block_rows(liked, np.array(recompute, dtype=np.int64), n, size, jobs)):
+        rows[col] = row
+
+    return ItemSimilarity.from_rows(book_ids, rows)
@@ -0,0 +1,171 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+import scoring
+
+# Levels of a "city, region, country" location, from the most to the least specific.
+# 'location' is the whole normalized string.
+LEVELS = ['location', 'city', 'region', 'country']
+
+# Bayesian prior used for the location recommendations (same as book_recs_pred.get_recs_by_loc)
+prior_n = scoring.prior_n
+prior_mu = scoring.prior_mu
+top_n = 20
+
+def normalize_location(location):
+    '''Lower case, single spaced, with ', ' between parts and empty or n/a parts removed.'''
+    if not isinstance(location, str):
+        return ''
+    parts = [re.sub(r'\s+', ' ', part).strip() for part in location.lower().split(',')]
+    return ', '.join(part for part in parts if part and part not in ('n/a', 'na', '-'))
+
+def split_location(locations):
+    ''' Split normalized locations into levels: city is the first part, country the last and region the second
+        (when there are three or more parts).
+        Args: locations (Pandas Series of strings)
+        Returns: Pandas Data Frame with location, city, region and country columns
+    '''
+    location = locations.map(normalize_location)
+    parts = location.str.split(', ')
+    n_parts = parts.str.len()
+    levels = pd.DataFrame({'location': location,
+                           'city': parts.str[0],
+                           'region': parts.str[1].where(n_parts >= 3),
+                           'country': parts.str[-1].where(n_parts >= 2)},
+                          index=locations.index)
+    return levels.replace('', None)
+
+def bayes_scores(stats, N=prior_n, mu=prior_mu):
+    return scoring.bayes_scores(stats['rating_sum'], stats['rating_count'], N, mu)
+
+def rank(stats, n=top_n):
+    '''Returns dictionary of (level, key): top n blf_book_ids by Bayes sum.'''
+    scored = stats.assign(score=bayes_scores(stats)).reset_index()
+    scored = scored.sort_values(['level', 'key', 'score', 'blf_book_id'], ascending=[True, True, False, True])
+    top = scored.groupby(['level', 'key'], sort=False).head(n)
+    return top.groupby(['level', 'key'], sort=False)['blf_book_id'].agg(list).to_dict()
+
+class LocationRankings:
+    ''' Top books per location key, ranked by Bayes sum, for every level in LEVELS.
+        top maps (level, key) to a list of blf_book_ids. The rating sums and counts they were ranked from
+        are kept apart (location_stats), since only the model update needs them.'''
+    def __init__(self, top, n=top_n):
+        self.n = n
+        self.top = top
+
+    def lookup(self, location, k=5):
+        ''' Resolve a location typed in the form to a key: the full location if it has several parts,
+            otherwise the city, region or country with that name.
+            Returns: list of blf_book_ids, or None if the location is not known
+        '''
+        location = normalize_location(location)
+        levels = ['location'] if ',' in location else ['city', 'region', 'country']
+        for level in levels:
+            if (level, location) in self.top:
+                return self.top[(level, location)][:k]
+        return None
+
+    def update(self, stats, ratings, users, removed=None):
+        ''' Add new ratings to stats and re-rank only the location keys they touch.
+            Args: stats (from location_stats), ratings (Pandas Data Frame with user_id, blf_book_id, book_rating),
+                  users (Pandas Data Frame with user_id and location for at least the users in ratings),
+                  removed (ratings to take out of stats, e.g. the ones replaced by new ratings)
+            Returns: updated stats
+        '''
+        delta = location_stats(ratings, users)
+        if removed is not None and len(removed):
+            delta = delta.sub(location_stats(removed, users), fill_value=0)
+        stats = stats.add(delta, fill_value=0)
+        stats = stats[stats['rating_count'] > 0]
+        touched = delta.reset_index()[['level', 'key']].drop_duplicates()
+        touched_stats = stats.reset_index().merge(touched, on=['level', 'key'])
+        self.top.update(rank(touched_stats.set_index(['level', 'key', 'blf_book_id']), self.n))
+        return stats
+
+def location_stats(ratings, users):
+    ''' Rating sums and counts per (level, key, blf_book_id).
+        Args: ratings (Pandas Data Frame with user_id, blf_book_id, book_rating),
+              users (Pandas Data Frame with user_id and location)
+        Returns: Pandas Data Frame indexed by level, key, blf_book_id
+    '''
+    users = users[users['location'].notna()]
+    user_levels = split_location(users['location'].astype(str)).assign(user_id=users['user_id'].values)
+    rated = ratings[['user_id', 'blf_book_id', 'book_rating']].merge(user_levels, on='user_id')
+
+    stats = []
+    for level in LEVELS:
+        grouped = rated.dropna(subset=[level]).groupby([level, 'blf_book_id'])['book_rating'].agg(['sum', 'count'])
+        grouped.index.names = ['key', 'blf_book_id']
+        stats.append(pd.concat({level: grouped}, names=['level']))
+    stats = pd.concat(stats)
+    stats.columns = ['rating_sum', 'rating_count']
+    return stats
+
+def build_rankings(ratings, users, n=top_n):
+    ''' Build LocationRankings from the merged ratings and users data frames.
+        Returns: LocationRankings, stats (for later updates)
+    '''
+    stats = location_stats(ratings, users)
+    return LocationRankings(rank(stats, n), n), stats
+
+class LocationIndex:
+    ''' In-memory index from locations to users, replacing LIKE 'prefix%' queries on the users table.
+        For each level the distinct keys are kept sorted, with the users grouped by key in the same order,
+        so the users for a key prefix are one contiguous slice found by binary search. A 'suffix' level holds
+        the reversed full locations, so "ends with" queries (everyone in "canada") work the same way.
+        Users are stored as int32 positions into user_ids.'''
+    def __init__(self, user_ids, levels):
+        self.user_ids = user_ids
+        self.levels = levels
+
+    @classmethod
+    def build(cls, users):
+        ''' Args: users (Pandas Data Frame with user_id and location)
+            Returns: LocationIndex
+        '''
+        users = users[users['location'].notna()]
+        user_levels = split_location(users['location'].astype(str))
+        user_levels['suffix'] = user_levels['location'].str[::-1]
+        user_ids = users['user_id'].to_numpy(dtype=str)
+
+        levels = {}
+        for level in LEVELS + ['suffix']:
+            keys = user_levels[level].to_numpy(dtype=object)
+            codes = np.flatnonzero(pd.notna(keys)).astype(np.int32)
+            keys = keys[codes].astype(str)
+            order = np.argsort(keys, kind='stable')
+            sorted_keys, starts = np.unique(keys[order], return_index=True)
+            offsets = np.append(starts, len(order)).astype(np.int64)
+            levels[level] = (sorted_keys, offsets, codes[order])
+        return cls(user_ids, levels)
+
+    def _range(self, level, text, prefix):
+        keys, offsets, codes = self.levels[level]
+        lo = np.searchsorted(keys, text, side='left')
+        hi = np.searchsorted(keys, text + '\U0010ffff', side='left') if prefix else np.searchsorted(keys, text, side='right')
+        return codes[offsets[lo]:offsets[hi]]
+
+    def prefix(self, text, level='location'):
+        '''Positions of the users whose key at level starts with text.'''
+        return self._range(level, normalize_location(text), prefix=True)
+
+    def exact(self, text, level):
+        '''Positions of the users whose key at level is text.'''
+        return self._range(level, normalize_location(text), prefix=False)
+
+    def suffix(self, text):
+        '''Positions of the users whose full location ends with text.'''
+        return self._range('suffix', normalize_location(text)[::-1], prefix=True)
+
+    def locations(self):
+        '''Returns: Pandas Data Frame with the user_id and (normalized) location of every indexed user.'''
+        keys, offsets, codes = self.levels['location']
+        location = np.empty(len(self.user_ids), dtype=object)
+        location[codes] = np.repeat(keys, np.diff(offsets))
+        return pd.DataFrame({'user_id': self.user_ids, 'location': location})
+
+    def users(self, location):
+        '''user_ids of the users whose location starts with location (what get_similar_users used to query).'''
+        return self.user_ids[self.prefix(location)]
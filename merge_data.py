@@ -1,19 +1,32 @@
 import argparse
+import book_recs_save
+import bulk_load
+import columnar_store
+import locations
 from data_prep import config
 from datetime import datetime
 from difflib import diff_bytes
+import google_books
 from xml.sax import default_parser_list
-import joblib
+import model_registry
+import numpy as np
 import os
 import pandas as pd
 import re
-import requests
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.neighbors import NearestNeighbors
+import time
+import titles
+import training
 import sqlalchemy as sa
 import psycopg2
 import wget
 from zipfile import ZipFile
+from pandas.api.types import union_categoricals
+
+# Rows read at a time from the large rating and user files
+chunk_size = int(os.environ.get('blf_chunk_size', 500000))
+
+# Columns of the merged ratings (ratings_final.csv)
+RATING_COLUMNS = ['uid','isbn','book_rating','user_id','book_id','blf_book_id']
 
 
 
@@ -21,28 +34,42 @@ def titlecase(string):
     regex = re.compile("[a-z]+('[a-z]+)?",re.I)
     return regex.sub(lambda grp: grp.group(0)[0].upper()+grp.group(0)[1:].lower(),string)
 
+def titlecase_series(titles):
+    ''' titlecase for a whole column. For ASCII titles without apostrophes str.title gives the same result,
+        so only the other titles go through the regex.
+        Args: titles (Pandas Series of strings, missing values stay missing)
+        Returns: Pandas Series
+    '''
+    titles = titles.astype(object)
+    present = titles.notna()
+    # Series.str.isascii needs a recent pandas, the mask is built with str.isascii itself
+    ascii_titles = titles.map(lambda title: isinstance(title, str) and title.isascii()).astype(bool)
+    fast = present & ascii_titles & ~titles.str.contains("'", regex=False).fillna(False).astype(bool)
+    result = titles.copy()
+    result[fast] = titles[fast].str.title()
+    slow = present & ~fast
+    result[slow] = titles[slow].map(titlecase)
+    return result
+
+def normalize_isbn(isbns):
+    '''ISBNs stripped and upper case (so the check digit X matches), missing values stay missing.'''
+    return isbns.str.strip().str.upper()
+
 def get_author_from_GB(isbn_list):
-    ''' Gets author from the Google Books API
+    ''' Gets author from the Google Books API, fetched concurrently through the rate limited google_books client
         Args: isbn_list (list of ISBNs to be searched)
-        Returns: author_list (list of authors to be updated in book data frame)
+        Returns: author_list (list of authors to be updated in book data frame, '' when not found or failed)
     '''
-    url = "https://www.googleapis.com/books/v1/volumes"
-    google_dict = dict()
-    author_list = []
-    for isbn in isbn_list:
-        response = requests.get(url, params={"q": 'isbn:'+isbn})
-        json = response.json()
-        
-        try:
-            if json['totalItems']!=0: # title does not exist in Google Books API
-                volume_info = json['items'][0]['volumeInfo']
-                author_list.append(','.join(volume_info['authors']))
-            else:
-                author_list.append('')
-        except KeyError as k:
-            print(k,isbn)
-            exit(0)
-
+    def authors(isbn, volume):
+        # title does not exist in Google Books API, or has no authors
+        if not volume:
+            return ''
+        return ','.join(volume.get('volumeInfo', {}).get('authors', []))
+
+    google_dict, errors = google_books.fetch_all(isbn_list, authors)
+    for isbn, error in errors.items():
+        print(isbn, error)
+    author_list = [google_dict.get(isbn, '') for isbn in isbn_list]
     return author_list
 
 def merge_books():
@@ -54,13 +81,13 @@ def merge_books():
     df_bx_books = pd.read_csv('BX-Books.csv', encoding='unicode-escape',sep=';',quotechar='"', on_bad_lines='warn')
 
     # Make X in ISBN with X upper-case
-    df_bx_books.loc[:,'ISBN'] = df_bx_books.loc[:,'ISBN'].apply(lambda x: x.strip().upper() if pd.notnull(x) else x)
+    df_bx_books.loc[:,'ISBN'] = normalize_isbn(df_bx_books.loc[:,'ISBN'])
 
     # Drop duplicate rows
     df_bx_books.drop_duplicates(inplace=True)
 
     # Book Author is missing for these 4 rows, creating a weird issue of column shift
-    missing_author = df_bx_books.loc[df_bx_books['Year-Of-Publication'].apply(pd.to_numeric,errors='coerce').isna()].index.to_list()
+    missing_author = df_bx_books.loc[pd.to_numeric(df_bx_books['Year-Of-Publication'],errors='coerce').isna()].index.to_list()
     df_bx_books.loc[missing_author,
                     ['Book-Author','Year-Of-Publication','Publisher','Image-URL-S','Image-URL-M','Image-URL-L']
                     ] = df_bx_books.loc[missing_author].iloc[:,2:].shift(1,axis=1)
@@ -72,7 +99,7 @@ def merge_books():
     # One of these books has part of the author's name in the year of publication
     df_bx_books.loc[missing_author,'Year-Of-Publication'] = df_bx_books.loc[missing_author,
         'Year-Of-Publication'].apply(lambda x: x.split('";')[1].split('"')[0] if len(x.split('";'))==2 else x)
-    df_bx_books['Year-Of-Publication'] = df_bx_books['Year-Of-Publication'].apply(pd.to_numeric)
+    df_bx_books['Year-Of-Publication'] = pd.to_numeric(df_bx_books['Year-Of-Publication'])
 
     # Missing authors
     indices = df_bx_books[df_bx_books['Book-Author'].isna()].index.to_list()
@@ -129,7 +156,7 @@ def merge_books():
 
     # the ISBN column does not currently have a zfill
     df_gr_books.isbn = df_gr_books.isbn.str.zfill(10)
-    df_gr_books.isbn = df_gr_books.isbn.apply(lambda x: str(x).strip().upper() if pd.notnull(x) else x)
+    df_gr_books.isbn = normalize_isbn(df_gr_books.isbn)
     df_gr_books.drop_duplicates(inplace=True)
 
     df_gr_books.columns = ['book_id', 'goodreads_book_id', 'best_book_id', 'work_id',
@@ -158,89 +185,116 @@ def merge_books():
     df_books.rename(columns={'index':'blf_book_id'},inplace=True)
     df_books.blf_book_id += 1
 
-    df_books.title = df_books.title.apply(titlecase)
+    df_books.title = titlecase_series(df_books.title)
 
     print('Book Data Frame Size: ',df_books.shape)
 
     return df_books
 
-def gr_users(ratings):
-    # Create Goodreads users dataframe
-    users = ['GR'+str(user).zfill(2) for user in sorted(ratings.user_id.unique())]
-    df_gr_users = pd.DataFrame(users,columns=['user_id'])
+def prefixed_ids(prefix, uids):
+    '''Unique user ids: prefix + uid with a zero fill to 2 digits (BX and 2 --> BX02), missing uids stay missing.'''
+    return prefix + uids.astype('Int64').astype('string').str.zfill(2)
+
+def gr_users(uids):
+    # Create Goodreads users dataframe from the Goodreads user numbers
+    users = prefixed_ids('GR', pd.Series(np.unique(uids)))
+    df_gr_users = pd.DataFrame({'user_id': users.astype(object)})
     df_gr_users['source']='Goodreads'
     df_gr_users[['location','age']]=None
 
     print('GR Users Data Frame Size: ',df_gr_users.shape)
     return df_gr_users
 
-def merge_ratings(books):
-    '''Merge Goodreads and Book Crossing data frames and create Goodreads user data frame
-        Args: books (Pandas Data Frame)
+def merge_ratings(books, output_path=None):
+    '''Merge Goodreads and Book Crossing data frames and create Goodreads user data frame.
+        The rating files are read in chunks of chunk_size rows with narrow dtypes, user ids and ISBNs are
+        normalized chunk by chunk and kept as categoricals, and ratings without a book are dropped as they come.
+        Args: books (Pandas Data Frame), output_path (CSV the ratings are appended to chunk by chunk, optional)
         Returns: df_ratings (Pandas Data Frame), df_gr_users (Pandas Data Frame)'''
+    time1 = time.perf_counter()
+    book_keys = books[['book_id','isbn','blf_book_id']].astype({'book_id': 'Int32', 'blf_book_id': 'Int32'})
+    parts = []
+    if output_path and os.path.exists(output_path):
+        os.remove(output_path)
+
+    def add(chunk):
+        # Keep only ratings of known books, write them out and keep a compact copy
+        chunk = chunk.loc[chunk.blf_book_id.notna(), RATING_COLUMNS]
+        if output_path:
+            chunk.to_csv(output_path, mode='a', header=not os.path.exists(output_path), index=False)
+        parts.append(chunk.astype({'user_id': 'category', 'isbn': 'category'}))
+
     # import bx ratings dataset
-    df_bx_ratings = pd.read_csv('BX-Book-Ratings.csv', low_memory=False, encoding='unicode_escape',sep=";", quotechar='"')
+    bx_dtypes = {'User-ID': 'Int32', 'ISBN': str, 'Book-Rating': 'float32'}
+    for chunk in pd.read_csv('BX-Book-Ratings.csv', encoding='unicode_escape', sep=";", quotechar='"',
+                             dtype=bx_dtypes, chunksize=chunk_size):
+        # Rename columns for parity between data frames
+        chunk.columns = ['uid','isbn','book_rating']
+
+        # Rescale BX ratings to 0-5 scale to match GR (currently BX scale is 0-10)
+        chunk['book_rating'] *= .5
 
-    # NOT SURE: Add count of ratings for the user - will do this in the data transformation earlier in the future
-    # df_bx_ratings['ratings_count']=df_bx_ratings.groupby('User-ID')['User-ID'].transform('count')
+        # Create user_id column from uid with prepend of 'BX' (zfill for uid <10, ex: uid=2 --> zfill=02)
+        chunk['user_id'] = prefixed_ids('BX', chunk.uid)
+
+        # Same ISBN normalization as the books, then add book_id (from GR dataset) and blf_book_id
+        chunk['isbn'] = normalize_isbn(chunk.isbn)
+        add(chunk.merge(book_keys, how='left', on=['isbn']))
+    training.report('BX ratings', time1)
 
     # import gr ratings dataset
     gr_ratings_file = 'ratings.csv'
     if not(os.path.exists(gr_ratings_file)):
         wget.download('https://raw.githubusercontent.com/zygmuntz/goodbooks-10k/master/ratings.csv')
-    
-    # Create Goodreads book ratings dataframe
-    df_gr_book_ratings = pd.read_csv('ratings.csv', encoding='unicode-escape', on_bad_lines='warn')
-
-    # Rename columns for parity between data frames
-    df_bx_ratings.columns = ['uid','isbn','book_rating']
 
-    # Rescale BX ratings to 0-5 scale to match GR (currently BX scale is 0-10)
-    df_bx_ratings.book_rating *= .5
+    gr_uids = []
+    gr_dtypes = {'user_id': 'int32', 'book_id': 'Int32', 'rating': 'float32'}
+    for chunk in pd.read_csv(gr_ratings_file, encoding='unicode-escape', on_bad_lines='warn',
+                             dtype=gr_dtypes, chunksize=chunk_size):
+        # Update Goodreads Ratings column names
+        chunk.columns = ['uid','book_id','book_rating']
+        gr_uids.append(np.unique(chunk.uid.to_numpy()))
 
-    # Create user_id column from uid with prepend of 'BX' (zfill for uid <10, ex: uid=2 --> zfill=02)
-    df_bx_ratings['user_id']=df_bx_ratings.uid.apply(lambda x: 'BX'+str(x).zfill(2) if pd.notnull(x) else x)
+        # Create user_id column from uid with prepend of 'GR'
+        chunk['user_id'] = prefixed_ids('GR', chunk.uid)
 
-    # Add book_id (from GR dataset) and blf_book_id (Booklover's Friend ID) column for parity
-    df_bx_ratings = df_bx_ratings.merge(books[['book_id','isbn','blf_book_id']], how='left', on=['isbn'])
+        # Add isbn and blf_book_id column for parity to GR Ratings data frame
+        add(chunk.merge(book_keys, how='left', on=['book_id']))
+    training.report('GR ratings', time1)
 
-    # Update Goodreads Ratings column names
-    df_gr_book_ratings.columns = ['uid','book_id','book_rating']
-
-    # Update df_gr_book_ratings rating column to a float
-    df_gr_book_ratings = df_gr_book_ratings.astype(dtype={'book_rating':'Float64'})
-
-    # Create user_id column from uid with prepend of 'GR'
-    df_gr_book_ratings['user_id'] = df_gr_book_ratings.uid.apply(lambda x: 'GR'+str(x).zfill(2))
-
-    # Add isbn and blf_book_id column for parity to GR Ratings data frame
-    df_gr_book_ratings = df_gr_book_ratings.merge(books[['book_id','isbn','blf_book_id']], how='left', on=['book_id'])
-
-    df_ratings = df_bx_ratings.merge(df_gr_book_ratings,how='outer',on=['blf_book_id','user_id','book_rating','isbn','book_id','uid'])
-    df_ratings[['book_id','blf_book_id']] = df_ratings[['book_id','blf_book_id']].astype('Int64')
-    df_ratings = df_ratings[~df_ratings.blf_book_id.isna()]
+    # Combine the chunks, merging the categories of the user and isbn columns
+    df_ratings = pd.DataFrame({column: union_categoricals([part[column] for part in parts])
+                               if column in ('user_id', 'isbn') else pd.concat([part[column] for part in parts], ignore_index=True)
+                               for column in RATING_COLUMNS})
+    training.report('ratings', time1)
 
     print('Ratings Data Frame Size: ', df_ratings.shape)
-    return df_ratings, gr_users(df_gr_book_ratings)
+    return df_ratings, gr_users(np.concatenate(gr_uids))
 
 def merge_users(df2):
     ''' Merge user data frames into a single user dataframe.
-        Args: None
+        Args: df2 (Goodreads users Pandas Data Frame)
         Returns: df_users (Pandas Data Frame)'''
+    time1 = time.perf_counter()
 
     # import bx users dataset
-    df_bx_users = pd.read_csv('BX-Users.csv', low_memory=False, encoding='unicode_escape',sep=";", quotechar='"')
-
-    # Rename columns for parity between data frames
-    df_bx_users.columns = ['uid','location','age']
+    bx_dtypes = {'User-ID': 'Int32', 'Location': str, 'Age': 'float32'}
+    chunks = []
+    for chunk in pd.read_csv('BX-Users.csv', encoding='unicode_escape', sep=";", quotechar='"',
+                             dtype=bx_dtypes, chunksize=chunk_size):
+        # Rename columns for parity between data frames
+        chunk.columns = ['uid','location','age']
 
-    # Create a unique user_id by prepending 'BX' to the user id (with a zero fill for user_id<10)
-    df_bx_users['user_id'] = df_bx_users.uid.apply(lambda x: 'BX'+str(x).zfill(2))
-    df_bx_users['source'] = 'Book Crossing'
+        # Create a unique user_id by prepending 'BX' to the user id (with a zero fill for user_id<10)
+        chunk['user_id'] = prefixed_ids('BX', chunk.uid).astype(object)
+        chunk['source'] = 'Book Crossing'
+        chunks.append(chunk)
 
-    df2.age = df2.age.astype('float')
+    df2.age = df2.age.astype('float32')
 
-    df_users = df_bx_users.merge(df2,how='outer',on=['user_id', 'location', 'age', 'source'])
+    # BX and GR user ids never overlap, so the users are the two frames one after the other
+    df_users = pd.concat(chunks + [df2], ignore_index=True)[['uid', 'location', 'age', 'user_id', 'source']]
+    training.report('users', time1)
 
     print('User Data Frame Size: ',df_users.shape)
     return df_users
@@ -251,31 +305,20 @@ def cover(df):
         Returns: list of thumbnail links to be appended to the books data frame
     '''
     print('creating cover html')
-    thumbnails = []
-    for index,row in df.iterrows():
-        image_link = row['image_s']
-        book_title = row['title']
-        blf_book_id = row['blf_book_id']
-        thumbnail_url = f'<a href="/book/{blf_book_id}"><img src={image_link} alt={book_title}>'
-        thumbnails.append(thumbnail_url)
-    return thumbnails
-
-def save_model(df_ratings):
-    ''' Saves K-Nearest Neighbors model for use in getting book recommendations.
-        Args: ratings (Pandas Data Frame)
+    thumbnails = ('<a href="/book/' + df['blf_book_id'].map(str) + '"><img src=' + df['image_s'].map(str)
+                  + ' alt=' + df['title'].map(str) + '>')
+    return thumbnails.tolist()
+
+def save_location_rankings(df_ratings, df_users):
+    ''' Saves the top books by Bayes sum for every location, city, region and country, and the index from
+        locations to users, so location recommendations are a lookup on the website.
+        Args: ratings (Pandas Data Frame), users (Pandas Data Frame)
     '''
-    print('saving model')
-    # Get ratings by user (as a dictionary in the form blf_bookid: ratings), vectorize for fitting the model
-    by_user_ratings = df_ratings[~df_ratings.blf_book_id.isna()].groupby('user_id').apply(
-    lambda items: {i[6]: i[3] for i in items.itertuples()})
-    features = DictVectorizer().fit_transform(by_user_ratings)
-
-    # Use K Nearest Neighbors to identify top 5 books
-    nn = NearestNeighbors(n_neighbors=20, metric='cosine', algorithm='brute').fit(features)
-    joblib.dump(nn, 'nn.pkl')
-    joblib.dump(by_user_ratings, 'by_user_ratings.pkl')
-    joblib.dump(features, 'features.pkl')
-    print('model saved!')
+    print('ranking books by location')
+    rankings, stats = locations.build_rankings(df_ratings, df_users)
+    location_index = locations.LocationIndex.build(df_users)
+    model_registry.publish({'location_rankings': rankings, 'location_stats': stats, 'location_index': location_index})
+    print('location rankings saved!')
 
 def main():
     parser = argparse.ArgumentParser()
@@ -287,6 +330,9 @@ def main():
     parser.add_argument('--sql_books', type=str)
     parser.add_argument('--sql_users', type=str)
     parser.add_argument('--sql_ratings', type=str)
+    parser.add_argument('--sql_method', type=str, default='copy', choices=['copy', 'insert'],
+                        help='copy: COPY into a staging table swapped in when loaded (bulk_load.py), insert: to_sql')
+    parser.add_argument('--store', type=str, help='Yes to publish the columnar store the website can read instead of SQL')
     args = parser.parse_args()
 
     books_filepath = 'books_final.csv'
@@ -302,34 +348,51 @@ def main():
             with ZipFile('BX-CSV-Dump.zip') as zip:
                 zip.extractall()
 
+        time1 = time.perf_counter()
         print('merging books')
         # Merge books and save file
         books_final = merge_books()
+        training.report('books', time1)
 
         print('adding covers')
         # Add cover html for link + cover image column - NEED to run this after merge
         books_final['cover']=cover(books_final)
+        training.report('covers', time1)
         
         print('merging ratings')
-        # Merge ratings and save file
-        ratings_final, df_gr_users = merge_ratings(books_final)
+        # Merge ratings and save file (written chunk by chunk when saving CSVs)
+        ratings_written = args.format == 'csv'
+        ratings_final, df_gr_users = merge_ratings(books_final, ratings_filepath if ratings_written else None)
+        training.report('ratings merged', time1)
         
         print('merging users')
         # Merge users and save file
         users_final = merge_users(df_gr_users)
+        training.report('users merged', time1)
 
         # Fit KNN model with updated data
-        save_model(ratings_final)
+        book_recs_save.save_model(ratings_final)
+        training.report('model', time1)
+
+        # Precompute location recommendations with updated data
+        save_location_rankings(ratings_final, users_final)
+        training.report('location rankings', time1)
+
+        # Index titles for the form lookups
+        model_registry.publish({'title_index': titles.TitleIndex.build(books_final, ratings_final)})
+        training.report('title index', time1)
 
     else:
         print('Update files argument was not yes')
         books_final = pd.read_csv(books_filepath, dtype={'pub_year':'Int64', 'original_title':str, 'lang':str})
-        ratings_final = pd.read_csv(ratings_filepath,usecols=['blf_book_id','user_id','book_rating'],dtype={'blf_book_id': 'Int32', 'user_id': str, 'book_rating':'Float32'})
+        ratings_written = False
+        ratings_final = pd.read_csv(ratings_filepath,usecols=['blf_book_id','user_id','book_rating'],dtype={'blf_book_id': 'Int32', 'user_id': 'category', 'book_rating':'float32'})
         users_final = pd.read_csv(users_filepath)
 
     if args.format == 'csv':
         books_final.to_csv('books_final.csv', index=False)
-        ratings_final.to_csv('ratings_final.csv', index=False)
+        if not ratings_written:
+            ratings_final.to_csv('ratings_final.csv', index=False)
         users_final.to_csv('users_final.csv', index=False)
         print('CSVs saved!')
     
@@ -347,7 +410,10 @@ def main():
             print('updating books')
             # Add data to BOOKS table
             time1 = datetime.now()
-            books_final.to_sql(name=books_tname,con=conn, if_exists='replace', chunksize=5000, method='multi', index=False)
+            if args.sql_method == 'copy':
+                bulk_load.load_table(conn, books_final, books_tname)
+            else:
+                books_final.to_sql(name=books_tname,con=conn, if_exists='replace', chunksize=5000, method='multi', index=False)
             time2 = datetime.now()
             print('time to add books:',time2-time1)
             print('Book table updated!',str(datetime.now()))
@@ -358,7 +424,10 @@ def main():
             
             # Add data to USERS table
             time1 = datetime.now()
-            users_final.to_sql(name=users_tname, con=conn, if_exists='replace', chunksize=50000, method='multi', index=False)
+            if args.sql_method == 'copy':
+                bulk_load.load_table(conn, users_final, users_tname)
+            else:
+                users_final.to_sql(name=users_tname, con=conn, if_exists='replace', chunksize=50000, method='multi', index=False)
             time2 = datetime.now()
             print('time to add users:',time2-time1)
             print('User table updated!')
@@ -370,13 +439,23 @@ def main():
             
             # Add data to RATINGS table
             time1 = datetime.now()
-            ratings_final.to_sql(name=ratings_tname,con=conn, if_exists='replace', chunksize=5000, method='multi', index=False)
+            if args.sql_method == 'copy':
+                bulk_load.load_table(conn, ratings_final, ratings_tname)
+            else:
+                ratings_final.to_sql(name=ratings_tname,con=conn, if_exists='replace', chunksize=5000, method='multi', index=False)
             time2 = datetime.now()
             print('time to add ratings:',time2-time1)
             print('Ratings table updated!')
         
         conn.dispose()
         print('SQL updated!')
+
+        # New model version for the data load, so websites drop recommendations cached from the old tables
+        model_registry.publish({'data_loaded': str(datetime.now())})
+
+    if args.store == 'Yes':
+        print('writing columnar store')
+        columnar_store.publish(ratings_final, users_final, books_final)
         
 if __name__ == '__main__':
     main()
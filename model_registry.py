@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import joblib
+
+# Directory that holds the published models, each version in its own sub-directory
+model_dir = os.environ.get('blf_model_dir', '.')
+
+# How often (seconds) a worker checks whether a new model version has been published
+check_interval = float(os.environ.get('blf_model_check_interval', 30))
+
+MANIFEST = 'model_version.json'
+
+# Artifacts written by merge_data.save_model before model versions existed
+LEGACY_ARTIFACTS = {'nn': 'nn.pkl', 'features': 'features.pkl', 'by_user_ratings': 'by_user_ratings.pkl'}
+
+# Artifacts only needed to build or update the model offline, workers do not load them
+OFFLINE_ARTIFACTS = {'location_stats'}
+
+class Model:
+    ''' One loaded version of the model artifacts (nn, features, by_user_ratings...).
+        Artifacts are read with model['nn'] or model.get('name') for optional ones.'''
+    def __init__(self, version, artifacts):
+        self.version = version
+        self.artifacts = artifacts
+
+    def __getitem__(self, name):
+        return self.artifacts[name]
+
+    def get(self, name, default=None):
+        return self.artifacts.get(name, default)
+
+def read_manifest(directory=None):
+    '''Returns the manifest of the current model version, or None if no version has been published.'''
+    path = os.path.join(directory or model_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def publish(artifacts, directory=None, remove=()):
+    ''' Save model artifacts as a new version and make it the current one.
+        Artifacts that are not passed are carried over from the current version, except those in remove.
+        Args: artifacts (dictionary of name: object), directory (model directory),
+              remove (names of artifacts the new version no longer has)
+        Returns: version (string)
+    '''
+    directory = directory or model_dir
+    version = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    version_dir = os.path.join('models', version)
+    os.makedirs(os.path.join(directory, version_dir), exist_ok=True)
+
+    current = read_manifest(directory)
+    files = {name: path for name, path in current['artifacts'].items() if name not in remove} if current else {}
+    for name, obj in artifacts.items():
+        files[name] = os.path.join(version_dir, name + '.pkl')
+        joblib.dump(obj, os.path.join(directory, files[name]))
+
+    # Write the manifest last and swap it in with a rename, so readers never see a half written version
+    manifest = {'version': version, 'created': str(datetime.now()), 'artifacts': files}
+    tmp_path = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+    print('model version', version, 'published!')
+    return version
+
+def load(directory=None, offline=False):
+    ''' Load the artifacts of the current model version (or the legacy pickles if nothing was published).
+        Args: directory (model directory), offline (also load OFFLINE_ARTIFACTS)
+        Returns: Model
+    '''
+    directory = directory or model_dir
+    manifest = read_manifest(directory)
+    if manifest is None:
+        version = 'legacy'
+        files = {name: path for name, path in LEGACY_ARTIFACTS.items() if os.path.exists(os.path.join(directory, path))}
+    else:
+        version = manifest['version']
+        files = manifest['artifacts']
+
+    artifacts = {name: joblib.load(os.path.join(directory, path)) for name, path in files.items()
+                 if offline or name not in OFFLINE_ARTIFACTS}
+    # The approximate index is pickled without a matrix and searches the features loaded with it
+    if artifacts.get('ann') is not None and artifacts.get('features') is not None:
+        artifacts['ann'].attach(artifacts['features'])
+    print('loaded model version', version)
+    return Model(version, artifacts)
+
+class ModelRegistry:
+    ''' Keeps the current Model in memory for the life of the worker process.
+        The model is loaded on first use (or with preload) and replaced in a single assignment when
+        a new version is published, so requests always see one complete version.'''
+    def __init__(self, directory=None, interval=None):
+        self.directory = directory or model_dir
+        self.interval = check_interval if interval is None else interval
+        self._model = None
+        self._mtime = None
+        self._checked = 0
+        self._load_lock = threading.Lock()
+        self._listeners = []
+
+    def _manifest_mtime(self):
+        try:
+            return os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _swap(self):
+        # Caller holds _load_lock
+        mtime = self._manifest_mtime()
+        model = load(self.directory)
+        self._model, self._mtime = model, mtime
+        return model
+
+    def _notify(self, model):
+        for listener in self._listeners:
+            listener(model.version)
+
+    def reload(self):
+        '''Load the current version from disk and swap it in.'''
+        with self._load_lock:
+            model = self._swap()
+        self._notify(model)
+        return model
+
+    def on_reload(self, listener):
+        '''Register a function called with the new version every time a model is swapped in.'''
+        self._listeners.append(listener)
+
+    def get(self):
+        '''Returns the current Model, checking for a newly published version at most every interval seconds.'''
+        model = self._model
+        if model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._swap()
+                    self._checked = time.monotonic()
+            return self._model
+
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            # Only one thread loads the new version; the others keep serving the old one meanwhile
+            if self._manifest_mtime() != self._mtime and self._load_lock.acquire(blocking=False):
+                try:
+                    model = self._swap()
+                finally:
+                    self._load_lock.release()
+                self._notify(model)
+        return self._model
+
+    @property
+    def version(self):
+        return self._model.version if self._model is not None else None
+
+registry = ModelRegistry()
+
+def get_model():
+    return registry.get()
@@ -0,0 +1,64 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    ''' Bounded in-process cache: least recently used entries are evicted past maxsize,
+        and entries older than ttl seconds are treated as missing. maxsize=0 disables caching.'''
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        '''Returns (found, value).'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                stored, value = entry
+                if time.monotonic() - stored <= self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+                self.expirations += 1
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions, 'expirations': self.expirations}
+
+def cached(cache, key):
+    ''' Decorator caching a function's results (lists, returned as copies) in cache.
+        Args: cache (TTLCache), key (function of the same arguments returning the cache key)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            cache_key = key(*args)
+            found, value = cache.get(cache_key)
+            if not found:
+                value = func(*args)
+                cache.set(cache_key, value)
+            return list(value)
+        wrapper.cache = cache
+        return wrapper
+    return decorator
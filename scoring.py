@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+
+# Bayesian prior for the recommendations: every book starts with N ratings of mu
+prior_n = 5
+prior_mu = 3
+
+def bayes_scores(sums, counts, N=prior_n, mu=prior_mu):
+    '''Bayes sum (sum + mu*N) / (count + N) of rating sums and counts (arrays or Pandas Series).'''
+    return (sums + mu*N) / (counts + N)
+
+def group_codes(keys):
+    ''' Dense codes 0..n_groups-1 for keys. Small non-negative integer keys (blf_book_ids) are used as codes
+        directly, anything else is factorized with np.unique.
+        Returns: groups (key of each code), codes (code of each key)
+    '''
+    keys = np.asarray(keys)
+    if keys.dtype.kind in 'iu' and len(keys) and keys.min() >= 0 and keys.max() < 4 * len(keys) + 1024:
+        return np.arange(keys.max() + 1), keys
+    return np.unique(keys, return_inverse=True)
+
+def group_stats(keys, ratings):
+    ''' Rating sums and counts per key. Missing (NaN) ratings count for neither, as with the pandas sum and count.
+        Returns: groups (keys), sums, counts -- only for the keys that have ratings (or only missing ones)
+    '''
+    groups, codes = group_codes(keys)
+    ratings = np.asarray(ratings, dtype=np.float64)
+    present = ~np.isnan(ratings)
+    sums = np.bincount(codes, weights=np.where(present, ratings, 0), minlength=len(groups))
+    counts = np.bincount(codes, weights=present, minlength=len(groups)).astype(np.int64)
+    rated = np.flatnonzero(np.bincount(codes, minlength=len(groups)))
+    return groups[rated], sums[rated], counts[rated]
+
+def top_k(keys, scores, k=5):
+    ''' The k keys with the highest scores, best first (ties go to the lowest key). Only the top k
+        are sorted, the rest are split off with a partial selection.
+        Returns: list of keys
+    '''
+    keys = np.asarray(keys)
+    scores = np.asarray(scores)
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+        # Keep every key tied with the k-th score, so the tie break does not depend on the partition
+        top = np.flatnonzero(scores >= scores[top].min())
+        keys, scores = keys[top], scores[top]
+    return keys[np.lexsort((keys, -scores))][:k].tolist()
+
+def bayes_top(keys, ratings, k=5, N=prior_n, mu=prior_mu):
+    ''' Rank keys (blf_book_ids) by the Bayes sum of their ratings.
+        Args: keys (one per rating), ratings, k (number of keys returned), N, mu (prior)
+        Returns: list of the k keys with the highest Bayes sum
+    '''
+    if len(keys) == 0:
+        return []
+    groups, sums, counts = group_stats(keys, ratings)
+    return top_k(groups, bayes_scores(sums, counts, N, mu), k)
+
+def benchmark(n_ratings, n_books, k=5, repeat=5, seed=0):
+    ''' Compare bayes_top with the pandas groupby + lambda + sort_values path it replaced,
+        on random ratings (the size of a large location).
+        Returns: dictionary with milliseconds per call for both and whether they agree
+    '''
+    import pandas as pd
+
+    def bayes_sum(N, mu):
+        return lambda x: (x.sum() + mu*N) / (x.count() + N)
+
+    rng = np.random.default_rng(seed)
+    # Skewed popularity, like the real ratings
+    keys = np.minimum(rng.zipf(1.3, n_ratings), n_books) - 1
+    ratings = rng.integers(0, 11, n_ratings) / 2
+    df = pd.DataFrame({'blf_book_id': keys, 'book_rating': ratings})
+
+    def pandas_top():
+        grouped = df.groupby('blf_book_id')['book_rating']
+        return grouped.aggregate(bayes_sum(prior_n, prior_mu)).sort_values(ascending=False).head(k).index.tolist()
+
+    results = {'ratings': n_ratings, 'books': n_books}
+    for name, func in [('pandas', pandas_top), ('scoring', lambda: bayes_top(keys, ratings, k))]:
+        time1 = time.perf_counter()
+        for _ in range(repeat):
+            top = func()
+        results[name + '_ms'] = (time.perf_counter() - time1) * 1000 / repeat
+        results[name + '_top'] = top
+    # Compare scores rather than ids, pandas breaks ties arbitrarily
+    groups, sums, counts = group_stats(keys, ratings)
+    scores = dict(zip(groups.tolist(), bayes_scores(sums, counts)))
+    results['agree'] = bool(np.allclose([scores[key] for key in results['pandas_top']],
+                                        [scores[key] for key in results['scoring_top']]))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ratings', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for n_ratings in args.ratings:
+        print(benchmark(n_ratings, args.books, repeat=args.repeat))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+import pandas as pd
+
+# Books per transaction when importing and rows per write when exporting
+batch_size = 1000
+
+class ScrapeStore:
+    ''' Scraped book metadata in one SQLite file, keyed like the old per book files (ISBN, or ISBN-book_id).
+        Each batch is written in one transaction, so a crash loses at most the batch being
+        written and a rerun carries on from the committed ones. A book scraped but not found is stored as ''.'''
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS books (key TEXT PRIMARY KEY, metadata TEXT, stored REAL)')
+        # Raw pages fetched and not necessarily parsed yet (zlib compressed), so parsing can run separately
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, final_url TEXT, html BLOB, stored REAL)')
+        self.conn.commit()
+
+    def keys(self):
+        '''Set of the keys already scraped, for constant time resume checks.'''
+        return {key for key, in self.conn.execute('SELECT key FROM books')}
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM books WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+    def add_many(self, books):
+        ''' Store scraped books in one transaction. A key already stored is replaced.
+            Args: books (dictionary of key: metadata dictionary or '')
+        '''
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO books VALUES (?, ?, ?)',
+                                  [(key, json.dumps(book), now) for key, book in books.items()])
+
+    def add(self, key, book):
+        self.add_many({key: book})
+
+    def books(self):
+        '''Generator of the stored metadata in the order it was scraped, read a row at a time.'''
+        for metadata, in self.conn.execute('SELECT metadata FROM books ORDER BY rowid'):
+            yield json.loads(metadata)
+
+    def add_page(self, key, html, final_url):
+        ''' Store a fetched page for parsing later.
+            Args: key (same key the parsed book will have), html (bytes), final_url (url after redirects)
+        '''
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                              (key, final_url, zlib.compress(html), time.time()))
+
+    def page_keys(self):
+        '''Set of the keys with a stored page.'''
+        return {key for key, in self.conn.execute('SELECT key FROM pages')}
+
+    def pages(self, keys):
+        ''' Generator of stored pages, read batch_size at a time.
+            Args: keys (list of page keys)
+            Returns: (key, html bytes, final_url) for each key with a page, in the order of keys
+        '''
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            rows = self.conn.execute('SELECT key, html, final_url FROM pages WHERE key IN (%s)' % ','.join('?' * len(batch)),
+                                     batch).fetchall()
+            # In the order of keys
+            rows = {key: (html, final_url) for key, html, final_url in rows}
+            for key in batch:
+                if key in rows:
+                    yield key, zlib.decompress(rows[key][0]), rows[key][1]
+
+    def import_files(self, directory, key=lambda stem: stem):
+        ''' Load the *_book-metadata.json files of an earlier run, so it resumes from them.
+            Args: directory, key (function of the file name without _book-metadata.json returning the store key)
+            Returns: number of files imported
+        '''
+        names = [name for name in os.listdir(directory)
+                 if name.endswith('_book-metadata.json') and not name.startswith('.')]
+        for start in range(0, len(names), batch_size):
+            books = {}
+            for name in names[start:start + batch_size]:
+                with open(os.path.join(directory, name)) as f:
+                    books[key(name.replace('_book-metadata.json', ''))] = json.load(f)
+            self.add_many(books)
+        return len(names)
+
+    def export_json(self, path):
+        '''Write all the books as one JSON list (the old all_books.json), streaming them from the store.'''
+        with open(path, 'w') as f:
+            f.write('[')
+            for i, book in enumerate(self.books()):
+                f.write((', ' if i else '') + json.dumps(book))
+            f.write(']')
+
+    def export_csv(self, path):
+        ''' Write the books found (not the '' entries) as CSV, batch_size rows at a time.
+            The columns are those of the first batch, later batches are aligned to them.
+        '''
+        columns = None
+        batch = []
+        for book in self.books():
+            if book:
+                batch.append(book)
+            if len(batch) == batch_size:
+                columns = self._write_csv(path, batch, columns)
+                batch = []
+        if batch or columns is None:
+            self._write_csv(path, batch, columns)
+
+    @staticmethod
+    def _write_csv(path, batch, columns):
+        df = pd.DataFrame(batch)
+        if columns is None:
+            df.to_csv(path, index=False, encoding='utf-8')
+            return list(df.columns)
+        df.reindex(columns=columns).to_csv(path, mode='a', header=False, index=False, encoding='utf-8')
+        return columns
+
+    def close(self):
+        self.conn.close()
+
+def open_store(directory, key=lambda stem: stem):
+    ''' The store of an output directory (books.sqlite), importing the per book JSON files of an earlier run
+        the first time it is created.
+        Args: directory, key (see ScrapeStore.import_files)
+        Returns: ScrapeStore
+    '''
+    store = ScrapeStore(os.path.join(directory, 'books.sqlite'))
+    if not len(store):
+        imported = store.import_files(directory, key)
+        if imported:
+            print(f'{imported} book metadata files imported into {store.path}')
+    return store
@@ -0,0 +1,120 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Synthetic books, users and ratings shaped like the merged BX + Goodreads data (books_final, users_final,
+# ratings_final), for benchmarks without the real files or a database.
+# Rows at scale 1 (the real data is around scale 30). Ratings are drawn base_ratings times, about a quarter
+# are repeats of a user and book already drawn and dropped.
+base_books = 10000
+base_users = 10000
+base_ratings = 200000
+
+# Zipf exponents of book popularity and user activity: a few books and users account for most ratings
+book_skew = 1.0
+user_skew = 0.8
+# Share of Book Crossing users (the rest are Goodreads users, who have no location)
+bx_share = 0.7
+# Share of BX ratings that are implicit (0), the rest are 1-10
+bx_implicit = 0.6
+bx_explicit_p = np.array([1, 1, 2, 3, 8, 10, 15, 22, 18, 20], dtype=float)
+gr_p = np.array([3, 8, 22, 35, 32], dtype=float)
+
+WORDS = ['the', 'of', 'and', 'night', 'house', 'love', 'war', 'secret', 'garden', 'dragon', 'city', 'river',
+         'lost', 'king', 'queen', 'shadow', 'girl', 'boy', 'summer', 'winter', 'dark', 'light', 'stone', 'fire',
+         'café', 'mystery', 'journey', 'last', 'first', 'little', 'world', 'heart', 'island', 'storm', 'book',
+         'harry', 'potter', "o'brien's", 'rings', 'time', 'history', 'guide', 'cookbook', 'murder', 'blood']
+COUNTRIES = ['usa', 'canada', 'united kingdom', 'germany', 'spain', 'australia', 'france', 'portugal', 'italy', 'n/a']
+
+def zipf_weights(n, skew, rng):
+    '''Probabilities proportional to rank^-skew, assigned to the n items in random order.'''
+    weights = np.arange(1, n + 1, dtype=float) ** -skew
+    return rng.permutation(weights / weights.sum())
+
+def make_books(n, rng):
+    ''' Returns: Pandas Data Frame with the books_final columns the website and the models read '''
+    blf_book_id = np.arange(1, n + 1)
+    # Titles of 1 to 5 words, some shared by several books (editions, common titles)
+    lengths = rng.integers(1, 6, n)
+    words = rng.choice(WORDS, lengths.sum())
+    titles = pd.Series(np.split(words, np.cumsum(lengths)[:-1])).map(' '.join).str.title()
+    shared = rng.random(n) < 0.05
+    titles[shared] = titles.sample(int(shared.sum()), replace=True, random_state=int(rng.integers(2**31))).values
+    isbn = pd.Series(rng.integers(0, 10**9, n)).map('{:09d}'.format) + rng.choice(list('0123456789X'), n)
+    image = 'http://images.example.com/images/P/' + isbn
+    books = pd.DataFrame({'blf_book_id': blf_book_id, 'isbn': isbn, 'title': titles,
+                          'authors': 'Author ' + pd.Series(rng.integers(0, max(n // 5, 1), n)).map(str),
+                          'pub_year': rng.integers(1900, 2021, n), 'publisher': 'Publisher ' + pd.Series(rng.integers(0, 200, n)).map(str),
+                          'image_s': image + '.01.THUMBZZZ.jpg', 'image_m': image + '.01.MZZZZZZZ.jpg',
+                          'image_l': image + '.01.LZZZZZZZ.jpg'})
+    books['cover'] = ('<a href="/book/' + books['blf_book_id'].map(str) + '"><img src=' + books['image_s']
+                      + ' alt=' + books['title'] + '>')
+    return books
+
+def make_users(n, rng):
+    ''' Returns: Pandas Data Frame with user_id (BX or GR prefixed), location (None for GR users), age, source '''
+    n_bx = int(n * bx_share)
+    # Locations "city, region, country", cities Zipf distributed so a few are shared by many users
+    n_cities = max(n // 20, 10)
+    city_p = zipf_weights(n_cities, 1.0, rng)
+    city_names = np.array(['city%d' % i for i in range(n_cities)], dtype=object)
+    city_region = rng.integers(0, 50, n_cities)
+    city_country = rng.choice(COUNTRIES, n_cities, p=[.4, .15, .1, .08, .06, .06, .05, .04, .04, .02])
+    cities = rng.choice(n_cities, n_bx, p=city_p)
+    location = (pd.Series(city_names[cities]) + ', region' + pd.Series(city_region[cities]).map(str) + ', '
+                + pd.Series(city_country[cities]))
+    bx = pd.DataFrame({'uid': np.arange(1, n_bx + 1), 'location': location,
+                       'age': np.where(rng.random(n_bx) < 0.4, np.nan, rng.integers(10, 90, n_bx)).astype('float32'),
+                       'source': 'Book Crossing'})
+    bx['user_id'] = 'BX' + bx['uid'].map(str).str.zfill(2)
+    gr = pd.DataFrame({'uid': np.arange(n - n_bx), 'location': None, 'age': np.float32('nan'), 'source': 'Goodreads'})
+    gr['user_id'] = 'GR' + gr['uid'].map(str).str.zfill(2)
+    return pd.concat([bx, gr], ignore_index=True)[['uid', 'location', 'age', 'user_id', 'source']]
+
+def make_ratings(n, users, books, rng):
+    ''' Ratings with Zipf book popularity and user activity. BX ratings are 0 (implicit) or 1-10 rescaled to
+        0.5-5 as merge_data does, GR ratings 1-5. A user rates a book at most once.
+        Returns: Pandas Data Frame with user_id, blf_book_id, book_rating
+    '''
+    user_rows = rng.choice(len(users), n, p=zipf_weights(len(users), user_skew, rng))
+    book_rows = rng.choice(len(books), n, p=zipf_weights(len(books), book_skew, rng))
+    is_bx = (users['source'].to_numpy() == 'Book Crossing')[user_rows]
+    bx_rating = np.where(rng.random(n) < bx_implicit, 0, rng.choice(np.arange(1, 11), n, p=bx_explicit_p / bx_explicit_p.sum())) * .5
+    gr_rating = rng.choice(np.arange(1, 6), n, p=gr_p / gr_p.sum())
+    ratings = pd.DataFrame({'user_id': users['user_id'].to_numpy()[user_rows],
+                            'blf_book_id': books['blf_book_id'].to_numpy()[book_rows],
+                            'book_rating': np.where(is_bx, bx_rating, gr_rating).astype('float32')})
+    return ratings.drop_duplicates(['user_id', 'blf_book_id'], ignore_index=True)
+
+def generate(scale=1.0, seed=0):
+    ''' Generate a dataset.
+        Args: scale (multiplies base_books, base_users and base_ratings), seed (same seed and scale, same data)
+        Returns: books, users, ratings (Pandas Data Frames shaped like books_final, users_final, ratings_final)
+    '''
+    rng = np.random.default_rng(seed)
+    books = make_books(max(int(base_books * scale), 10), rng)
+    users = make_users(max(int(base_users * scale), 10), rng)
+    ratings = make_ratings(max(int(base_ratings * scale), 100), users, books, rng)
+    return books, users, ratings
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_directory_path', type=str, default='.')
+    args = parser.parse_args()
+
+    time1 = time.perf_counter()
+    books, users, ratings = generate(args.scale, args.seed)
+    os.makedirs(args.output_directory_path, exist_ok=True)
+    books.to_csv(os.path.join(args.output_directory_path, 'books_final.csv'), index=False)
+    users.to_csv(os.path.join(args.output_directory_path, 'users_final.csv'), index=False)
+    ratings.to_csv(os.path.join(args.output_directory_path, 'ratings_final.csv'), index=False)
+    print(f'{len(books)} books, {len(users)} users, {len(ratings)} ratings written to {args.output_directory_path} '
+          f'in {time.perf_counter() - time1:.1f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import re
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+# Trigrams found in more than this share of the titles are skipped when a query has rarer ones
+common_trigram_share = 0.05
+
+# Autocomplete results are precomputed for prefixes up to this length
+short_prefix_length = 3
+completions = 10
+
+# Fuzzy matches need at least this Jaccard similarity of trigrams to be suggested
+min_similarity = 0.3
+
+def normalize_title(title):
+    '''Lower case ASCII letters and digits only, single spaced (accents are dropped: "Café" -> "cafe").'''
+    if not isinstance(title, str):
+        return ''
+    title = unicodedata.normalize('NFKD', title).encode('ascii', 'ignore').decode('ascii').lower()
+    title = title.replace('&amp;', '&').replace('&', ' and ')
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', title).split())
+
+def trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TitleIndex:
+    ''' In-memory title lookups, replacing the title LIKE + ratings join in form_info.get_blf_book_id.
+        Books are kept in normalized title order (keys), with for each one its blf_book_id, title, whether it
+        has a 5 star rating and its number of ratings. Exact matches are a dictionary lookup, prefix matches
+        a binary search in keys and fuzzy matches go through a trigram inverted index.'''
+    def __init__(self, book_ids, titles, keys, five_star, rating_counts):
+        self.book_ids = book_ids
+        self.titles = titles
+        self.keys = keys
+        self.five_star = five_star
+        self.rating_counts = rating_counts
+
+        # Exact matches: 5 star rated books first, then lowest blf_book_id (as the SQL query ordered them)
+        self.exact = defaultdict(list)
+        for pos in np.lexsort((book_ids, ~five_star)):
+            self.exact[keys[pos]].append(pos)
+        self.exact = dict(self.exact)
+
+        # Autocomplete answers for the 1 to short_prefix_length character prefixes, whose ranges are too long
+        # to rank on every keystroke
+        self.short_prefixes = {}
+        for prefix in sorted({key[:n] for key in keys for n in range(1, short_prefix_length + 1)}):
+            self.short_prefixes[prefix] = self._top_in_range(*self.prefix_range(prefix), completions)
+
+        # Trigram -> positions of the titles containing it
+        postings = defaultdict(list)
+        for pos, key in enumerate(keys):
+            for gram in trigrams(key):
+                postings[gram].append(pos)
+        self.trigrams = {gram: np.array(positions, dtype=np.int32) for gram, positions in postings.items()}
+        self.trigram_counts = np.array([len(trigrams(key)) for key in keys], dtype=np.int32)
+
+    @classmethod
+    def build(cls, books, ratings):
+        ''' Args: books (Pandas Data Frame with blf_book_id and title),
+                  ratings (Pandas Data Frame with blf_book_id and book_rating)
+            Returns: TitleIndex
+        '''
+        books = books[['blf_book_id', 'title']].dropna().drop_duplicates('blf_book_id')
+        books = books.assign(
+            rating_count=books['blf_book_id'].map(ratings['blf_book_id'].value_counts()),
+            five_star=books['blf_book_id'].isin(ratings.loc[ratings['book_rating'] == 5.0, 'blf_book_id']))
+        books['key'] = books['title'].map(normalize_title)
+        books = books[books['key'] != ''].sort_values(['key', 'blf_book_id'])
+
+        return cls(books['blf_book_id'].to_numpy(dtype=np.int64),
+                   books['title'].to_numpy(dtype=object),
+                   books['key'].to_numpy(dtype=str),
+                   books['five_star'].fillna(False).to_numpy(dtype=bool),
+                   books['rating_count'].fillna(0).to_numpy(dtype=np.int64))
+
+    def update(self, ratings, replaced, features, book_ids):
+        ''' Index with the rating counts and 5 star flags after new ratings (update_model). The titles are
+            unchanged, books without a title in the index are only added by a full build.
+            Args: ratings (Pandas Data Frame of the new ratings), replaced (old ratings they replaced, from
+                  training.update_rating_matrix), features, book_ids (updated rating matrix)
+            Returns: TitleIndex
+        '''
+        ratings = ratings.dropna(subset=['user_id', 'blf_book_id']).drop_duplicates(['user_id', 'blf_book_id'], keep='last')
+        counts = ratings['blf_book_id'].astype(np.int64).value_counts().sub(
+            replaced['blf_book_id'].astype(np.int64).value_counts(), fill_value=0)
+        rating_counts = self.rating_counts + pd.Series(self.book_ids).map(counts).fillna(0).to_numpy(dtype=np.int64)
+
+        # A replaced rating can take away a book's only 5 star rating, so the rated books are read from the matrix
+        five_star = self.five_star.copy()
+        rated = np.isin(self.book_ids, counts.index.to_numpy())
+        columns = features.tocsc()[:, np.searchsorted(book_ids, self.book_ids[rated])]
+        five_star[rated] = np.asarray((columns == 5.0).sum(axis=0)).ravel() > 0
+        return TitleIndex(self.book_ids, self.titles, self.keys, five_star, rating_counts)
+
+    def prefix_range(self, prefix):
+        '''Positions lo, hi of the titles whose normalized title starts with prefix.'''
+        lo = np.searchsorted(self.keys, prefix, side='left')
+        hi = np.searchsorted(self.keys, prefix + '\x7f', side='left')
+        return lo, hi
+
+    def _top_in_range(self, lo, hi, k):
+        # Positions of the k most rated books in [lo, hi), one per distinct title
+        positions = np.arange(lo, hi)
+        if len(positions) > 4 * k:
+            positions = positions[np.argpartition(-self.rating_counts[positions], 4 * k - 1)[:4 * k]]
+        positions = positions[np.argsort(-self.rating_counts[positions], kind='stable')]
+        _, first = np.unique(self.titles[positions].astype(str), return_index=True)
+        return positions[np.sort(first)][:k].astype(np.int32)
+
+    def complete(self, prefix, k=completions):
+        ''' Autocomplete: the k titles starting with prefix (after normalization) with the most ratings.
+            Returns: list of dictionaries with blf_book_id and title
+        '''
+        key = normalize_title(prefix)
+        if not key:
+            return []
+        if key in self.short_prefixes and k <= completions:
+            positions = self.short_prefixes[key][:k]
+        else:
+            positions = self._top_in_range(*self.prefix_range(key), k)
+        return [{'blf_book_id': int(self.book_ids[pos]), 'title': self.titles[pos]} for pos in positions]
+
+    def _fuzzy(self, key, k):
+        grams = [gram for gram in trigrams(key) if gram in self.trigrams]
+        rare = [gram for gram in grams if len(self.trigrams[gram]) <= common_trigram_share * len(self.keys)]
+        if not grams:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        positions, shared = np.unique(np.concatenate([self.trigrams[gram] for gram in (rare or grams)]),
+                                      return_counts=True)
+        # Jaccard similarity of the trigram sets
+        scores = shared / (len(trigrams(key)) + self.trigram_counts[positions] - shared)
+        positions, scores = positions[scores >= min_similarity], scores[scores >= min_similarity]
+        if len(positions) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            positions, scores = positions[top], scores[top]
+        return positions, scores
+
+    def resolve(self, title, k=10):
+        ''' Candidate books for a title typed in the form: exact (normalized) matches, then titles starting with it,
+            then the closest titles by trigram similarity. Only the best book of each normalized title is listed.
+            Returns: list of dictionaries with blf_book_id, title, five_star, match ('exact', 'prefix' or 'fuzzy')
+        '''
+        key = normalize_title(title)
+        candidates = []
+        seen = set()
+
+        def add(positions, match):
+            for pos in positions:
+                if self.keys[pos] not in seen and len(candidates) < k:
+                    seen.add(self.keys[pos])
+                    candidates.append({'blf_book_id': int(self.book_ids[pos]), 'title': self.titles[pos],
+                                       'five_star': bool(self.five_star[pos]), 'match': match})
+
+        add(self.exact.get(key, []), 'exact')
+        if key and len(candidates) < k:
+            lo, hi = self.prefix_range(key)
+            positions = np.arange(lo, hi)
+            add(positions[np.lexsort((-self.rating_counts[positions], ~self.five_star[positions]))][:k], 'prefix')
+        if key and len(candidates) < k:
+            positions, scores = self._fuzzy(key, k)
+            order = np.lexsort((-self.rating_counts[positions], -scores))
+            add(positions[order], 'fuzzy')
+        return candidates
+
+    def best(self, title):
+        '''blf_book_id of the 5 star rated book with exactly this (normalized) title, or None.'''
+        for pos in self.exact.get(normalize_title(title), []):
+            if self.five_star[pos]:
+                return int(self.book_ids[pos])
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=str, default='books_final.csv')
+    parser.add_argument('--ratings', type=str, default='ratings_final.csv')
+    args = parser.parse_args()
+
+    import model_registry
+    books = pd.read_csv(args.books, usecols=['blf_book_id', 'title'])
+    ratings = pd.read_csv(args.ratings, usecols=['blf_book_id', 'book_rating'],
+                          dtype={'blf_book_id': 'Int32', 'book_rating': 'Float32'})
+    model_registry.publish({'title_index': TitleIndex.build(books, ratings)})
+
+if __name__ == '__main__':
+    main()
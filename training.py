@@ -0,0 +1,83 @@
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+def peak_rss_mb():
+    '''Peak resident memory of this process so far, in MB (ru_maxrss is in KB on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def rss_mb():
+    '''Current resident memory of this process in MB (Linux only, None elsewhere).'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return None
+
+def report(stage, time1):
+    ''' Print the time taken since time1 (time.perf_counter()), the current memory and the peak memory so far.
+        Returns: seconds taken
+    '''
+    seconds = time.perf_counter() - time1
+    rss = rss_mb()
+    current = f'RSS {rss:.0f} MB, ' if rss is not None else ''
+    print(f'{stage}: {seconds:.1f} s, {current}peak RSS {peak_rss_mb():.0f} MB')
+    return seconds
+
+def rating_matrix(ratings):
+    ''' Users x books sparse ratings matrix, built straight from dense codes of user_id and blf_book_id.
+        Args: ratings (Pandas Data Frame with user_id, blf_book_id, book_rating)
+        Returns: features (CSR matrix, float32), user_ids (user_id of each row, sorted),
+                 book_ids (blf_book_id of each column, sorted)
+    '''
+    ratings = ratings.dropna(subset=['user_id', 'blf_book_id'])
+    # A user's last rating of a book wins (as it did with one dictionary per user)
+    ratings = ratings.drop_duplicates(['user_id', 'blf_book_id'], keep='last')
+
+    user_codes, user_ids = pd.factorize(ratings['user_id'].astype(str), sort=True)
+    book_codes, book_ids = pd.factorize(ratings['blf_book_id'].astype(np.int64), sort=True)
+    features = sparse.csr_matrix((ratings['book_rating'].to_numpy(dtype=np.float32), (user_codes, book_codes)),
+                                 shape=(len(user_ids), len(book_ids)))
+    features.sort_indices()
+    return features, np.asarray(user_ids, dtype=str), np.asarray(book_ids, dtype=np.int64)
+
+def update_rating_matrix(features, user_ids, book_ids, ratings):
+    ''' Add new ratings to a matrix built by rating_matrix without rebuilding it. New users and books get rows
+        and columns in sorted order, a new rating of a book the user had already rated replaces the old one.
+        Args: features, user_ids, book_ids (from rating_matrix or a previous update),
+              ratings (Pandas Data Frame with the new user_id, blf_book_id, book_rating)
+        Returns: features, user_ids, book_ids (updated), user_rows (new row of each old row),
+                 changed_rows (rows with new ratings), replaced (Pandas Data Frame of the old ratings replaced)
+    '''
+    ratings = ratings.dropna(subset=['user_id', 'blf_book_id'])
+    ratings = ratings.drop_duplicates(['user_id', 'blf_book_id'], keep='last')
+    delta_users = ratings['user_id'].to_numpy(dtype=str)
+    delta_books = ratings['blf_book_id'].to_numpy(dtype=np.int64)
+
+    new_user_ids = np.union1d(user_ids, delta_users)
+    new_book_ids = np.union1d(book_ids, delta_books)
+    user_rows = np.searchsorted(new_user_ids, user_ids)
+    book_cols = np.searchsorted(new_book_ids, book_ids)
+
+    # Old entries moved to their new rows and columns
+    old = features.tocoo()
+    rows, cols, data = user_rows[old.row], book_cols[old.col], old.data
+    delta_rows = np.searchsorted(new_user_ids, delta_users)
+    delta_cols = np.searchsorted(new_book_ids, delta_books)
+
+    # Entries (row, col) are compared as row * columns + col
+    n_cols = len(new_book_ids)
+    replaced = np.isin(rows.astype(np.int64) * n_cols + cols, delta_rows.astype(np.int64) * n_cols + delta_cols)
+    replaced_ratings = pd.DataFrame({'user_id': new_user_ids[rows[replaced]],
+                                     'blf_book_id': new_book_ids[cols[replaced]],
+                                     'book_rating': data[replaced]})
+
+    keep = ~replaced
+    features = sparse.csr_matrix((np.concatenate((data[keep], ratings['book_rating'].to_numpy(dtype=np.float32))),
+                                  (np.concatenate((rows[keep], delta_rows)), np.concatenate((cols[keep], delta_cols)))),
+                                 shape=(len(new_user_ids), n_cols))
+    features.sort_indices()
+    return features, new_user_ids, new_book_ids, user_rows, np.unique(delta_rows), replaced_ratings
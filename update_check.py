@@ -0,0 +1,84 @@
+import argparse
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+import ann_index
+import item_similarity
+import synthetic_data
+import titles
+import training
+
+# Check of the incremental update (update_model) against a full rebuild: a synthetic dataset is split into a
+# base and a delta that holds a sample of ratings plus every rating of the lowest blf_book_ids, so the update
+# inserts new books before all the others and moves every column. The updated rating matrix, approximate
+# index, item similarity table and title index must equal the ones built from all the ratings.
+
+def codes(ann):
+    '''Bucket code of every row in every table (rows x tables).'''
+    result = np.empty((ann._sorted_codes.shape[1], ann.n_tables), dtype=np.int32)
+    for t in range(ann.n_tables):
+        result[ann._order[t], t] = ann._sorted_codes[t]
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=0.3, help='synthetic_data scale')
+    parser.add_argument('--delta', type=float, default=0.02, help='share of the ratings in the delta')
+    parser.add_argument('--new_books', type=int, default=50, help='lowest blf_book_ids only in the delta')
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    books, users, ratings = synthetic_data.generate(args.scale)
+    rng = np.random.default_rng(1)
+    in_delta = (rng.random(len(ratings)) < args.delta) | (ratings['blf_book_id'] <= args.new_books).to_numpy()
+    base, delta = ratings[~in_delta], ratings[in_delta]
+
+    features, user_ids, book_ids = training.rating_matrix(base)
+    ann = ann_index.LSHNearestNeighbors(n_neighbors=20).fit(features, book_ids)
+    table = item_similarity.build(features, book_ids)
+    title_index = titles.TitleIndex.build(books, base)
+
+    features, user_ids, book_ids, user_rows, changed_rows, replaced = training.update_rating_matrix(
+        features, user_ids, book_ids, delta)
+    ann = ann.update(features, user_rows, changed_rows, book_ids)
+    table = item_similarity.update(table, features, book_ids, delta['blf_book_id'].unique())
+    title_index = title_index.update(delta, replaced, features, book_ids)
+
+    full_features, full_user_ids, full_book_ids = training.rating_matrix(ratings)
+    full_ann = ann_index.LSHNearestNeighbors(n_neighbors=20, n_bits=ann.n_bits).fit(full_features, full_book_ids)
+    full_table = item_similarity.build(full_features, full_book_ids)
+    print(f'{len(base)} base ratings, {len(delta)} in the delta, {len(book_ids) - len(np.unique(base["blf_book_id"]))} new books')
+
+    problems = []
+    if not (np.array_equal(user_ids, full_user_ids) and np.array_equal(book_ids, full_book_ids)
+            and (features != full_features).nnz == 0):
+        problems.append('rating matrix differs')
+
+    same_codes = float(np.mean(np.all(codes(ann) == codes(full_ann), axis=1)))
+    print(f'approximate index: {same_codes:.1%} of the rows have the codes of a fresh fit')
+    if same_codes < 1:
+        problems.append('approximate index codes differ')
+    nn = NearestNeighbors(n_neighbors=20, metric='cosine', algorithm='brute').fit(full_features)
+    rows = rng.choice(full_features.shape[0], min(args.queries, full_features.shape[0]), replace=False)
+    for name, index in [('updated', ann), ('fresh', full_ann)]:
+        recall = ann_index.compare(index, nn, full_features[rows], probes=[2])[1]['recall']
+        print(f'{name} index recall at n_probes=2: {recall:.3f}')
+
+    different = [b for b in full_book_ids if table.similar(b, item_similarity.top_n) != full_table.similar(b, item_similarity.top_n)]
+    print(len(different), 'books with different item similarity rows')
+    if different:
+        problems.append('item similarity differs')
+
+    full_title_index = titles.TitleIndex.build(books, ratings)
+    if not all(np.array_equal(getattr(title_index, name), getattr(full_title_index, name))
+               for name in ['book_ids', 'five_star', 'rating_counts']):
+        problems.append('title index differs')
+
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+import columnar_store
+import item_similarity
+import locations
+import model_registry
+import training
+
+def update_data(ratings, users, data_directory='.', sql_url=None):
+    ''' Add the new ratings and users to ratings_final.csv and users_final.csv (a new rating of a book the user
+        had already rated replaces it, as in the model), and reload the ratings and users tables when sql_url
+        is given, so the data the website reads and later full builds start from has them too.
+        Args: ratings, users (as update_model), data_directory (where merge_data wrote the CSVs),
+              sql_url (database URL, optional)
+        Returns: ratings, users, books (Pandas Data Frames of all the data)
+    '''
+    path = lambda name: os.path.join(data_directory, name + '_final.csv')
+    books = pd.read_csv(path('books'), dtype={'pub_year': 'Int64', 'original_title': str, 'lang': str})
+    all_ratings = pd.read_csv(path('ratings'), dtype={'user_id': str, 'isbn': str, 'blf_book_id': 'Int64', 'book_rating': 'float32'})
+    all_users = pd.read_csv(path('users'), dtype={'user_id': str, 'location': str})
+
+    ratings = ratings.dropna(subset=['user_id', 'blf_book_id']).drop_duplicates(['user_id', 'blf_book_id'], keep='last')
+    pairs = lambda df: pd.MultiIndex.from_arrays([df['user_id'].astype(str), df['blf_book_id'].astype('int64')])
+    all_ratings = pd.concat([all_ratings[~pairs(all_ratings).isin(pairs(ratings))], ratings], ignore_index=True)
+    all_users = pd.concat([all_users, users[~users['user_id'].isin(all_users['user_id'])]], ignore_index=True)
+
+    for name, df in [('ratings', all_ratings), ('users', all_users)]:
+        # Written next to the old file and renamed over it, so a failed write leaves the old file
+        df.to_csv(path(name) + '.tmp', index=False)
+        os.replace(path(name) + '.tmp', path(name))
+    if sql_url:
+        import sqlalchemy as sa
+        import bulk_load
+        engine = sa.create_engine(sql_url)
+        bulk_load.load_table(engine, all_ratings, 'ratings')
+        bulk_load.load_table(engine, all_users, 'users')
+        engine.dispose()
+    return all_ratings, all_users, books
+
+def update_model(ratings, users, directory=None, data_directory='.', sql_url=None):
+    ''' Apply a delta of new ratings and users to the current model and publish it as a new version,
+        instead of rebuilding everything with merge_data / save_model.
+        The ratings matrix and id maps are patched, the approximate index hashes only the users with new ratings,
+        the item similarity table and the title index recompute only the books with new ratings and the location
+        rankings only the locations of the users who rated. Users already in the model keep their location.
+        The ratings and users are added to the data files (and tables) with update_data, and the columnar
+        ratings_store, when the model has one, is written again from them and published in the same version.
+        Args: ratings (Pandas Data Frame with user_id, blf_book_id, book_rating),
+              users (Pandas Data Frame with user_id and location of the new users),
+              data_directory, sql_url (see update_data)
+        Returns: version (string)
+    '''
+    time1 = time.perf_counter()
+    model = model_registry.load(directory, offline=True)
+    if model.get('user_ids') is None:
+        raise ValueError('model has no user_ids, run a full save_model (merge_data.py --update_files Yes) first')
+    training.report('load model', time1)
+
+    # Ratings matrix and id maps
+    features, user_ids, book_ids, user_rows, changed_rows, replaced = training.update_rating_matrix(
+        model['features'], model['user_ids'], model['book_ids'], ratings)
+    print(len(ratings), 'new ratings,', len(replaced), 'replaced,', len(user_ids) - len(user_rows), 'new users,',
+          len(book_ids) - len(model['book_ids']), 'new books')
+    artifacts = {'features': features, 'user_ids': user_ids, 'book_ids': book_ids}
+    training.report('rating matrix', time1)
+
+    # Brute force kNN only keeps the matrix, so refitting it is cheap
+    artifacts['nn'] = NearestNeighbors(n_neighbors=20, metric='cosine', algorithm='brute').fit(features)
+    if model.get('ann') is not None:
+        artifacts['ann'] = model['ann'].update(features, user_rows, changed_rows, book_ids)
+        training.report('approximate index', time1)
+
+    if model.get('item_similarity') is not None:
+        artifacts['item_similarity'] = item_similarity.update(model['item_similarity'], features, book_ids,
+                                                              ratings['blf_book_id'].dropna().unique())
+        training.report('item similarity', time1)
+
+    # Location of the users who rated: the new users, then the ones already in the location index
+    location_index = model.get('location_index')
+    if location_index is not None:
+        known = location_index.locations()
+        new_users = users[~users['user_id'].isin(known['user_id'])]
+        all_users = pd.concat([known, new_users[['user_id', 'location']]], ignore_index=True)
+        if len(new_users):
+            artifacts['location_index'] = locations.LocationIndex.build(all_users)
+        if model.get('location_rankings') is not None and model.get('location_stats') is not None:
+            rankings = model['location_rankings']
+            artifacts['location_stats'] = rankings.update(model['location_stats'], ratings, all_users, replaced)
+            artifacts['location_rankings'] = rankings
+        training.report('location rankings', time1)
+
+    if model.get('title_index') is not None:
+        artifacts['title_index'] = model['title_index'].update(ratings, replaced, features, book_ids)
+        training.report('title index', time1)
+
+    # The read backend gets the same ratings as the model: the data files and tables, and the columnar store
+    data_ratings, data_users, books = update_data(ratings, users, data_directory, sql_url)
+    training.report('data files', time1)
+    if model.get('ratings_store') is not None:
+        artifacts['ratings_store'] = columnar_store.write(data_ratings, data_users, books,
+                                                         columnar_store.new_directory(directory))
+        training.report('columnar store', time1)
+
+    version = model_registry.publish(artifacts, directory)
+    training.report('update', time1)
+    return version
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ratings', type=str, required=True, help='CSV of new ratings (user_id, blf_book_id, book_rating)')
+    parser.add_argument('--users', type=str, help='CSV of new users (user_id, location)')
+    parser.add_argument('--model_dir', type=str)
+    parser.add_argument('--data_directory', type=str, default='.', help='directory of books_final.csv, ratings_final.csv and users_final.csv')
+    parser.add_argument('--sql', type=str, help='Yes to also reload the ratings and users tables (database at blf_sql)')
+    args = parser.parse_args()
+
+    ratings = pd.read_csv(args.ratings, usecols=['user_id', 'blf_book_id', 'book_rating'],
+                          dtype={'blf_book_id': 'Int64', 'user_id': str, 'book_rating': 'Float32'})
+    users = (pd.read_csv(args.users, usecols=['user_id', 'location'], dtype=str) if args.users
+             else pd.DataFrame({'user_id': pd.Series(dtype=str), 'location': pd.Series(dtype=str)}))
+    update_model(ratings, users, args.model_dir, args.data_directory, os.environ.get('blf_sql') if args.sql == 'Yes' else None)
+
+if __name__ == '__main__':
+    main()